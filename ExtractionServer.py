@@ -0,0 +1,398 @@
+"""
+Long-running extraction server.
+Loads spaCy and SpanBERT once and runs ISE jobs against the warm models.
+"""
+import argparse
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from lib import log as ise_log
+from lib.backends import SPANBERT_BACKENDS, load_spanbert
+from lib.nlp import load_pipeline
+from lib.utils import positiveInt
+
+# Options of a job naming files the server writes: {args attribute: flag}.
+JOB_PATH_OPTIONS = {
+    "cache": "-cache",
+    "metrics": "-metrics",
+    "relations_out": "-relations-out",
+    "checkpoint": "-checkpoint",
+}
+
+
+class ExtractionJob:
+    "One ISE run submitted to the server"
+
+    def __init__(self, job_id: int, argv: List[str], args) -> None:
+        """
+        Initialize an ExtractionJob object
+        Parameters:
+            job_id: the job's id
+            argv: the command line arguments of the job, as main.py takes them
+            args: argv, parsed
+        Instance Variables:
+            status: one of "queued", "running", "done", "failed"
+            iteration: the current ISE iteration
+            query: the current query
+            num_relations: the number of relations extracted so far
+            relations: the final relations, as table rows
+        """
+        self.id = job_id
+        self.argv = argv
+        self.args = args
+        self.status = "queued"
+        self.iteration = 0
+        self.query = args.q
+        self.num_relations = 0
+        self.relations: List[List] = []
+        self.iterations = 0
+        self.error: Optional[str] = None
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+    def toDict(self) -> Dict:
+        """
+        Returns: the job's state as a JSON-serializable dictionary
+        """
+        return {
+            "id": self.id,
+            "status": self.status,
+            "method": "gpt3" if self.args.gpt3 else "spanbert",
+            "r": self.args.r,
+            "k": self.args.k,
+            "iteration": self.iteration,
+            "query": self.query,
+            "num_relations": self.num_relations,
+            "relations": self.relations,
+            "iterations": self.iterations,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class ExtractionServer:
+    "Queues ISE jobs and runs them on worker threads sharing warm models"
+
+    def __init__(self, workers: int = 2, job_dir: Optional[str] = None) -> None:
+        """
+        Initialize an ExtractionServer object
+        Parameters:
+            workers: the number of jobs run concurrently
+            job_dir: the directory the files named by jobs (caches, metrics, relation
+                     output, checkpoints) are confined to (None: jobs can't name files)
+        Instance Variables:
+            models: the loaded models {name: model}, shared by every job
+            jobs: all submitted jobs {id: ExtractionJob}
+            pending: the queue of jobs waiting for a worker
+        """
+        self.job_dir = os.path.realpath(job_dir) if job_dir else None
+        self.models: Dict = {}
+        self.models_lock = threading.Lock()
+        self.jobs: Dict[int, ExtractionJob] = {}
+        self.pending: "queue.Queue[ExtractionJob]" = queue.Queue()
+        self.ids = itertools.count(1)
+        for i in range(workers):
+            threading.Thread(
+                target=self.work, name=f"job-worker-{i}", daemon=True
+            ).start()
+
+    def warmModels(
+        self, spanbert: bool, fast_sentences: bool = False, backend: str = "fp32"
+    ) -> Dict:
+        """
+        Get the models a job needs, loading each one the first time it is asked for
+        Parameters:
+            spanbert: whether the job uses SpanBERT
+            fast_sentences: whether the job splits sentences with spaCy's senter
+            backend: the SpanBERT inference backend of the job
+        Returns:
+            models: {"nlp": spaCy pipeline, "spanbert": SpanBERT model (if needed)}
+        """
+        with self.models_lock:
+            nlp_key = "nlp-senter" if fast_sentences else "nlp"
+            if nlp_key not in self.models:
+                print(f"Loading spaCy ({nlp_key}) ...")
+                self.models[nlp_key] = load_pipeline(fast_sentences=fast_sentences)
+            models = {"nlp": self.models[nlp_key]}
+            if spanbert:
+                spanbert_key = f"spanbert-{backend}"
+                if spanbert_key not in self.models:
+                    print(f"Loading SpanBERT ({backend}) ...")
+                    self.models[spanbert_key] = load_spanbert(backend)
+                models["spanbert"] = self.models[spanbert_key]
+        return models
+
+    def submit(self, argv: List[str]) -> ExtractionJob:
+        """
+        Queue a job
+        Parameters:
+            argv: the command line arguments of the job, as main.py takes them
+        Returns:
+            ExtractionJob - the queued job
+        Raises:
+            ValueError - if argv is not a valid main.py command line, or one the
+                         server does not run (-processes, files outside the job directory)
+        """
+        from main import parse_arguments
+
+        try:
+            args = parse_arguments(argv)
+        except SystemExit:
+            raise ValueError(f"invalid job arguments: {argv}")
+        # The job runs here; it must not be forwarded again.
+        args.server = None
+        if args.processes > 1:
+            # Worker processes would load their own models instead of the warm ones.
+            raise ValueError("-processes is not supported by server jobs")
+        for name, flag in JOB_PATH_OPTIONS.items():
+            path = getattr(args, name)
+            if path is None or (name == "metrics" and path == "-"):
+                continue
+            setattr(args, name, self.jobPath(flag, path))
+        job = ExtractionJob(next(self.ids), argv, args)
+        self.jobs[job.id] = job
+        self.pending.put(job)
+        return job
+
+    def jobPath(self, flag: str, path: str) -> str:
+        """
+        Resolve a file named by a job inside the job directory
+        Returns:
+            str - the absolute path
+        Raises:
+            ValueError - without a job directory, or if path leads outside of it
+        """
+        if self.job_dir is None:
+            raise ValueError(f"{flag} requires a server started with -job-dir")
+        resolved = os.path.realpath(os.path.join(self.job_dir, path))
+        if os.path.commonpath([resolved, self.job_dir]) != self.job_dir:
+            raise ValueError(f"{flag} must name a file inside the server's -job-dir")
+        return resolved
+
+    def work(self) -> None:
+        while True:
+            job = self.pending.get()
+            try:
+                self.runJob(job)
+            except Exception as e:
+                job.status = "failed"
+                job.error = f"{type(e).__name__}: {e}"
+            finally:
+                job.finished = time.time()
+
+    def runJob(self, job: ExtractionJob) -> None:
+        """
+        Run one job's ISE loop to completion
+        """
+        from main import run_ise
+        from QueryExecutor import QueryExecutor
+
+        job.status = "running"
+        job.started = time.time()
+        models = self.warmModels(
+            job.args.spanbert, job.args.fast_sentences, job.args.spanbert_backend
+        )
+        executor = QueryExecutor(job.args, models=models)
+
+        def progress(iteration: int, query: str) -> None:
+            job.iteration = iteration
+            job.query = query
+            job.num_relations = len(executor.extractor.relations)
+
+        try:
+            job.iterations = run_ise(executor, progress)
+            job.num_relations = len(executor.extractor.relations)
+            job.relations = relationRows(executor.extractor.relations)
+            executor.printRunStats()
+        finally:
+            executor.close()
+        job.status = "done"
+
+
+def relationRows(relations) -> List[List]:
+    """
+    Convert an extractor's relations to table rows:
+    [confidence, subject, object] sorted by confidence for SpanBERT, [subject, object] for GPT-3
+    """
+    if relations.scored:
+        return [[conf, subj, obj] for (subj, obj), conf in relations.ranked()]
+    return [[subj, obj] for subj, obj in relations]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API:
+        POST /jobs       {"argv": [...main.py arguments...]} -> the queued job
+        GET  /jobs       -> all jobs (without their relations)
+        GET  /jobs/<id>  -> one job
+    """
+
+    def sendJson(self, code: int, payload) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        if self.path != "/jobs":
+            return self.sendJson(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            argv = json.loads(self.rfile.read(length))["argv"]
+            job = self.server.extraction.submit([str(arg) for arg in argv])
+        except (ValueError, KeyError, TypeError) as e:
+            return self.sendJson(400, {"error": str(e)})
+        self.sendJson(202, job.toDict())
+
+    def do_GET(self) -> None:
+        jobs = self.server.extraction.jobs
+        if self.path == "/jobs":
+            summaries = []
+            for job in list(jobs.values()):
+                summary = job.toDict()
+                del summary["relations"]
+                summaries.append(summary)
+            return self.sendJson(200, summaries)
+        if self.path.startswith("/jobs/"):
+            try:
+                job = jobs[int(self.path[len("/jobs/") :])]
+            except (ValueError, KeyError):
+                return self.sendJson(404, {"error": "no such job"})
+            return self.sendJson(200, job.toDict())
+        self.sendJson(404, {"error": "not found"})
+
+    def log_message(self, format, *args) -> None:
+        # Job output already goes to stdout; keep the access log out of it.
+        pass
+
+
+def run_remote(server_url: str, argv: List[str], poll_interval: float = 2.0) -> None:
+    """
+    Thin client: submit a job to a running server, follow its progress and
+    print the extracted relations.
+    Parameters:
+        server_url: the server's base URL, e.g. http://localhost:8080
+        argv: the main.py arguments of the job (without -server)
+        poll_interval: seconds between progress checks
+    """
+    from prettytable import PrettyTable
+
+    from lib.utils import RELATIONS
+
+    base = server_url.rstrip("/")
+    request = urllib.request.Request(
+        f"{base}/jobs",
+        data=json.dumps({"argv": argv}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        job = json.loads(response.read())
+    print(f"Submitted job {job['id']} to {base}")
+
+    last = None
+    while job["status"] in ("queued", "running"):
+        time.sleep(poll_interval)
+        with urllib.request.urlopen(f"{base}/jobs/{job['id']}") as response:
+            job = json.loads(response.read())
+        state = (job["status"], job["iteration"], job["num_relations"])
+        if state != last:
+            print(
+                f"Job {job['id']}: {job['status']} - Iteration: {job['iteration']}"
+                f" - Query: {job['query']} - Relations: {job['num_relations']}"
+            )
+            last = state
+
+    if job["status"] == "failed":
+        print(f"Job {job['id']} failed: {job['error']}")
+        return
+    print(
+        f"================== ALL RELATIONS for {RELATIONS[job['r']]} ( {job['num_relations']} ) ================="
+    )
+    table = PrettyTable()
+    table.align = "l"
+    if job["method"] == "gpt3":
+        table.field_names = ["Subject", "Object"]
+    else:
+        table.field_names = ["Confidence", "Subject", "Object"]
+    table.add_rows(job["relations"])
+    print(table)
+    print(f"Total # of iterations = {job['iterations']}")
+
+
+def main():
+    """
+    Handles command line arguments and starts the server
+    """
+    parser = argparse.ArgumentParser(
+        description="Extraction server keeping spaCy and SpanBERT loaded across ISE jobs"
+    )
+    parser.add_argument("-host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument(
+        "-port", type=positiveInt, default=8080, help="port to listen on; int > 0"
+    )
+    parser.add_argument(
+        "-workers",
+        type=positiveInt,
+        default=2,
+        help="number of jobs run concurrently; int > 0",
+    )
+    parser.add_argument(
+        "-preload",
+        choices=["spanbert", "gpt3"],
+        default=None,
+        help="load the models of one method before accepting jobs",
+    )
+    parser.add_argument(
+        "-preload-backend",
+        dest="preload_backend",
+        choices=SPANBERT_BACKENDS,
+        default="fp32",
+        help="SpanBERT backend loaded by -preload spanbert",
+    )
+    parser.add_argument(
+        "-job-dir",
+        dest="job_dir",
+        default=None,
+        help="directory the -cache, -metrics, -relations-out and -checkpoint files of jobs "
+        "are confined to (relative paths are resolved in it); jobs can't name files if omitted",
+    )
+    parser.add_argument(
+        "-log",
+        choices=ise_log.LOG_MODES,
+        default="verbose",
+        help="progress output of the jobs (the -log of submitted jobs is ignored)",
+    )
+    args = parser.parse_args()
+
+    ise_log.configure(args.log)
+    extraction = ExtractionServer(workers=args.workers, job_dir=args.job_dir)
+    if args.preload:
+        extraction.warmModels(
+            spanbert=args.preload == "spanbert", backend=args.preload_backend
+        )
+    httpd = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    httpd.extraction = extraction
+    print(f"Extraction server listening on http://{args.host}:{args.port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        ise_log.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,19 @@
 "GPT3 Extractor class"
 import json
+import logging
 import re
-from typing import List, Set, Tuple
+import time
+from typing import Dict, List, Optional, Tuple, Union
 
 import openai
-import spacy
-from spacy_help_functions import create_entity_pairs
 
+from lib.dedup import SentenceIndex
+from lib.entities import RelationTypeIndex
+from lib.log import getLogger, logRelation
+from lib.nlp import annotate_batch, load_pipeline
+from lib.relations import RelationStore
+from lib.ratelimit import CompletionDispatcher, RateLimiter
 from lib.utils import (
-    ENTITIES_OF_INTEREST,
     PROMPT_AIDS,
     PRONOUNS_AND_CONJUNCTIONS,
     RELATIONS,
@@ -17,25 +22,88 @@ from lib.utils import (
     SUBJ_OBJ_REQUIRED_ENTITIES,
 )
 
+log = getLogger("gpt3")
+
+GPT3_MODEL = "text-davinci-003"
+GPT3_PARAMS = {
+    "max_tokens": 100,
+    "temperature": 0.2,
+    "top_p": 1,
+    "frequency_penalty": 0.0,
+    "presence_penalty": 0.0,
+}
+# Completion budget per sentence of a packed prompt.
+PACKED_TOKENS_PER_SENTENCE = 60
+
 
 class gpt3Extractor:
     """
     GPT3 Extractor class
     """
 
-    def __init__(self, r, openai_key, model="en_core_web_sm"):
+    def __init__(
+        self,
+        r,
+        openai_key,
+        model="en_core_web_sm",
+        fast_sentences=False,
+        n_process=1,
+        completion_cache=None,
+        workers=4,
+        rpm=None,
+        tpm=None,
+        api_base=None,
+        pack=1,
+        nlp=None,
+        sentence_store=None,
+        replay=False,
+    ):
         """
         Initialize a gpt3Predictor object
         Parameters:
             r: the relation to extract
             openai_key: the key to use for the OpenAI API
             model: the spaCy model to use
+            fast_sentences: split sentences with spaCy's senter instead of the parser
+            n_process: the number of processes used by annotate_batch
+            completion_cache: a CompletionCache memoizing gpt3_complete (None: disabled)
+            workers: the maximum number of completion requests in flight
+            rpm: the requests-per-minute budget (None: unlimited)
+            tpm: the tokens-per-minute budget (None: unlimited)
+            api_base: an alternative OpenAI-compatible endpoint (e.g. a local stub server)
+            pack: the number of candidate sentences sent per prompt
+            nlp: an already loaded spaCy pipeline to share (loaded from model if None)
+            sentence_store: a SentenceStore keeping GPT-3's answer per sentence across runs (None: this run only)
+            replay: if True, completions only come from completion_cache; the API is never called
         """
+        # Passed with every request rather than set on the openai module: extractors
+        # of concurrent extraction server jobs may use different keys and endpoints.
         self.openai_key = openai_key
-        openai.api_key = self.openai_key
-        self.nlp = spacy.load(model)
+        self.api_base = api_base
+        self.nlp = nlp if nlp is not None else load_pipeline(model, fast_sentences)
+        self.n_process = n_process
+        self.completion_cache = completion_cache
+        self.pack = pack
+        self.replay = replay
+        self.dispatcher = CompletionDispatcher(
+            self.request_completion,
+            workers=workers,
+            limiter=RateLimiter(rpm, tpm),
+            max_tokens=GPT3_PARAMS["max_tokens"],
+            retry_on=(
+                openai.error.RateLimitError,
+                openai.error.ServiceUnavailableError,
+                openai.error.APIConnectionError,
+                openai.error.Timeout,
+            ),
+        )
         self.r = r
-        self.relations = set()
+        self.type_index = RelationTypeIndex(r)
+        self.sentence_index = SentenceIndex(f"gpt3:{GPT3_MODEL}:{r}", sentence_store)
+        # GPT-3 relations have no confidence: the store keeps them in extraction order.
+        self.relations = RelationStore(scored=False)
+        # The RelationSink relations are written to as they are extracted (None: off).
+        self.sink = None
 
     def get_relations(self, text: str) -> List[Tuple[str, str]]:
         """
@@ -45,23 +113,63 @@ class gpt3Extractor:
         Returns:
             entities: a list of tuples of the form (subject, object)
         """
-        doc = self.nlp(text)
-        print("        Annotating the webpage using spacy...")
+        return self.get_relations_from_doc(self.annotate(text))
+
+    def annotate(self, text: str):
+        """
+        Annotate text with spaCy
+        Parameters:
+            text: the text to annotate
+        Returns:
+            doc: the spaCy document
+        """
+        return self.nlp(text)
+
+    def annotate_batch(self, texts: List[str]) -> List:
+        """
+        Annotate several texts with spaCy in one batch
+        Parameters:
+            texts: the texts to annotate
+        Returns:
+            docs: the spaCy documents, in the same order as texts
+        """
+        return annotate_batch(self.nlp, texts, len(texts), self.n_process)
+
+    def get_relations_from_doc(self, doc) -> List[Tuple[str, str]]:
+        """
+        Extract relations from a document already annotated by spaCy
+        Parameters:
+            doc: the spaCy document to extract relations from
+        Returns:
+            entities: a list of tuples of the form (subject, object)
+        """
+        log.debug("        Annotating the webpage using spacy...")
         num_sents = len(list(doc.sents))
-        print(
+        log.debug(
             f"        Extracted {num_sents} sentences. Processing each sentence one by one to check for presence of right pair of named entity types; if so, will run the second pipeline ..."
         )
 
         # Get tagged version of text from spaCy.
-        target_candidate_pairs = self.extract_candidate_pairs(doc)
-
-        if len(target_candidate_pairs) == 0:
-            return []
-        # print("target_candidate_pairs: {}".format(target_candidate_pairs))
-        self.extract_entity_relations(target_candidate_pairs)
+        self.extract_candidate_pairs(doc)
         return self.relations
 
-    def extract_candidate_pairs(self, doc) -> Set[Tuple[str, str]]:
+    def merge_relations(self, relations: List[Tuple[str, str]]) -> int:
+        """
+        Merge relations extracted elsewhere (e.g. by a worker process)
+        Parameters:
+            relations: a list of tuples of the form (subject, object)
+        Returns:
+            merged: the number of relations not extracted before
+        """
+        merged = 0
+        for relation in relations:
+            if self.relations.upsert(relation) is None:
+                if self.sink is not None:
+                    self.sink.write(tuple(relation))
+                merged += 1
+        return merged
+
+    def extract_candidate_pairs(self, doc) -> RelationStore:
         """
         Extract candidate pairs from a given document using spaCy
         parameters:
@@ -73,91 +181,165 @@ class gpt3Extractor:
         num_sents = len(list(doc.sents))
         extracted_sentences = 0
         extracted_annotations = 0
+        candidate_sentences = []
+        # Per sentence, in order: (sentence, fingerprint, queued for GPT-3, output).
+        # Sentences already processed are not queued; their output comes from the
+        # sentence index.
+        plan = []
+        queued = set()
         for i, sentence in enumerate(doc.sents):
             if i % 5 == 0 and i != 0:
-                print(f"        Processed {i} / {num_sents} sentences")
-            # Create entity pairs
-            sentence_entity_pairs = create_entity_pairs(
-                sentence, ENTITIES_OF_INTEREST[self.r]
-            )
+                log.debug(f"        Processed {i} / {num_sents} sentences")
+            # Check if any appropriate subj/obj pairing exists. Sentences whose entity
+            # labels cannot make up such a pair are skipped before any pair is built.
+            if not self.type_index.keep(sentence):
+                log.debug("		No potential relations found in this sentence...")
+                continue
+            # Sentences seen before (on this page, another page, or a previous run)
+            # reuse GPT-3's answer instead of being sent again.
+            fingerprint = self.sentence_index.fingerprint(sentence.text)
+            if fingerprint in queued:
+                plan.append((sentence, fingerprint, False, None))
+                continue
+            results = self.sentence_index.lookup(fingerprint)
+            if results is not None:
+                plan.append((sentence, fingerprint, False, results[0] if results else None))
+                continue
+            candidates = self.type_index.candidatePairs(sentence)
 
-            # Check entity pairs if any appropriate subj/obj pairing exists
-            candidates = self.filter_candidates_exist(sentence_entity_pairs)
-
-            # If any viable candidates exist, pass to GPT-3 for extraction
+            # If any viable candidates exist, queue the sentence for GPT-3
             if candidates:
-                relation = self.extract_entity_relations(sentence)
-                output = self.parse_gpt_output(relation)
-                # If GPT-3 returns invalid relation, move on to next sentence
-                if not output:
-                    continue
-                # If GPT-3 returns valid relation, check if it's a duplicate
-                output_tuple = (output["subj"], output["obj"])
-                if output_tuple not in self.relations:
-                    # If not a duplicate, add to set, print output
-                    self.relations.add(output_tuple)
-                    extracted_annotations += 1
-                    extracted_sentences += 1
-                    self.print_output_relation(sentence, output, duplicate=False)
-                else:
-                    # If duplicate, print output and move on
-                    self.print_output_relation(sentence, output, duplicate=True)
+                queued.add(fingerprint)
+                candidate_sentences.append(sentence)
+                plan.append((sentence, fingerprint, True, None))
+            else:
+                self.sentence_index.add(fingerprint, [])
+                log.debug("		No potential relations found in this sentence...")
+
+        # Issue the completions concurrently, then handle the answers in sentence order.
+        outputs, answered = self.complete_sentences(candidate_sentences)
+        answers = iter(zip(outputs, answered))
+        for sentence, fingerprint, sent, output in plan:
+            if sent:
+                output, ok = next(answers)
+                # Failed requests are not recorded, so a repeat of the sentence is retried.
+                if ok:
+                    self.sentence_index.add(fingerprint, [output] if output else [])
+            elif fingerprint in queued:
+                # Repeated on this page: its first occurrence has been answered by now.
+                results = self.sentence_index.lookup(fingerprint)
+                output = results[0] if results else None
+            # If GPT-3 returns invalid relation, move on to next sentence
+            if not output:
+                continue
+            # If GPT-3 returns valid relation, check if it's a duplicate
+            output_tuple = (output["subj"], output["obj"])
+            if self.relations.upsert(output_tuple) is None:
+                # If not a duplicate, add to set, print output
+                if self.sink is not None:
+                    self.sink.write(output_tuple)
+                extracted_annotations += 1
+                extracted_sentences += 1
+                self.print_output_relation(sentence, output, duplicate=False)
+            else:
+                # If duplicate, print output and move on
+                self.print_output_relation(sentence, output, duplicate=True)
+        self.sentence_index.flush()
 
-        print(
+        log.info(
             f"Extracted annotations for  {extracted_sentences}  out of total  {num_sents}  sentences"
         )
-        print(
+        log.info(
             f"Relations extracted from this website: {extracted_annotations} (Overall: {len(self.relations)})"
         )
         return self.relations
 
-    def print_output_relation(self, sentence, output, duplicate):
-        print("                === Extracted Relation ===")
-        print(f"                Sentence:  {sentence}")
-        print(f"                Subject: {output['subj']} ; Object: {output['obj']} ;")
-        if duplicate:
-            print("                Duplicate. Ignoring this.")
-        else:
-            print("                Adding to set of extracted relations")
-        print("                ==========")
-
-    def filter_candidates_exist(self, sentence_entity_pairs: List) -> bool:
+    def complete_sentences(
+        self, sentences
+    ) -> Tuple[List[Optional[Dict]], List[bool]]:
         """
-        Filter candidate pairs to only include those that are of the right type
+        Ask GPT-3 for the relation in each sentence.
+        With packing enabled, up to self.pack sentences share one prompt; the
+        sentences of a packed prompt whose answer can't be parsed, or that its
+        answer leaves out, are retried one sentence per prompt.
         Parameters:
-            sentence_entity_pairs: a list of candidate entity pairs, where each pair is a dictionary
+            sentences: the candidate sentences
         Returns:
-            bool: if at least 1 viable candidate pair exists, return True. Else, False.
-        """
-        # Create candidate pairs. Filter out subject-object pairs that
-        # aren't the right type for the target relation.
-        # (e.g. don't include anything that's not Person:Organization for the "Work_For" relation)
-        candidate_pairs = []
-        for ep in sentence_entity_pairs:
-            candidate_pairs.append(
-                {"tokens": ep[0], "subj": ep[1], "obj": ep[2]}
-            )  # e1=Subject, e2=Object
-            candidate_pairs.append(
-                {"tokens": ep[0], "subj": ep[2], "obj": ep[1]}
-            )  # e1=Object, e2=Subject
+            outputs: the parsed relation of each sentence (None if there is none)
+            answered: for each sentence, False if its completion request failed
+        """
+        if self.pack <= 1:
+            completions = self.dispatcher.map(
+                [self.construct_prompt(sentence) for sentence in sentences],
+                self.gpt3_complete,
+            )
+            outputs = [
+                self.parse_gpt_output(c) if c is not None else None
+                for c in completions
+            ]
+            return outputs, [c is not None for c in completions]
 
-        for p in candidate_pairs:
-            if (
-                p["subj"][1] in SUBJ_OBJ_REQUIRED_ENTITIES[self.r]["SUBJ"]
-                and p["obj"][1] in SUBJ_OBJ_REQUIRED_ENTITIES[self.r]["OBJ"]
-            ):
-                return True
+        chunks = [
+            sentences[i : i + self.pack] for i in range(0, len(sentences), self.pack)
+        ]
+        completions = self.dispatcher.map(
+            [self.construct_packed_prompt(chunk) for chunk in chunks],
+            self.gpt3_complete_packed,
+        )
+        outputs = []
+        answered = [True] * len(sentences)
+        fallback = []
+        for chunk, completion in zip(chunks, completions):
+            parsed = self.parse_packed_gpt_output(completion, len(chunk))
+            if parsed is None:
+                log.warning(
+                    f"        Could not parse packed GPT-3 output; retrying {len(chunk)} sentences one by one"
+                )
+                parsed = {}
+            elif len(parsed) < len(chunk):
+                log.warning(
+                    f"        Packed GPT-3 output left out {len(chunk) - len(parsed)} sentences; retrying them one by one"
+                )
+            for position in range(len(chunk)):
+                if position not in parsed:
+                    fallback.append(len(outputs) + position)
+            outputs.extend(parsed.get(position) for position in range(len(chunk)))
+        if fallback:
+            completions = self.dispatcher.map(
+                [self.construct_prompt(sentences[i]) for i in fallback],
+                self.gpt3_complete,
+            )
+            for i, completion in zip(fallback, completions):
+                if completion is not None:
+                    outputs[i] = self.parse_gpt_output(completion)
+                else:
+                    answered[i] = False
+        return outputs, answered
 
-        print("		No potential relations found in this sentence...")
-        # This info, formatted, should be printed in extract_candidate_pairs.
-        # print("Filtered target_candidate_paris: {}".format(target_candidate_pairs))
-        return False
+    def print_output_relation(self, sentence, output, duplicate):
+        if not duplicate:
+            logRelation("gpt3", (output["subj"], output["obj"]))
+        # Only build the block (and format the sentence) if it will be shown.
+        if not log.isEnabledFor(logging.DEBUG):
+            return
+        lines = [
+            "                === Extracted Relation ===",
+            f"                Sentence:  {sentence}",
+            f"                Subject: {output['subj']} ; Object: {output['obj']} ;",
+        ]
+        if duplicate:
+            lines.append("                Duplicate. Ignoring this.")
+        else:
+            lines.append("                Adding to set of extracted relations")
+        lines.append("                ==========")
+        log.debug("\n".join(lines))
 
-    def parse_gpt_output(self, output_str: str):
+    def parse_gpt_output(self, output_str: Union[str, Dict]):
         """
         Parse the output of GPT-3
         Parameters:
             output: the output of GPT-3, string '{"PERSON": "John Doe", "ORGANIZATION": "Google", "RELATION": "Work_For"}'
+                    (or the same object already decoded from a packed answer)
         Returns:
             resultant_relation: the extracted relation as a dict
                         with format:
@@ -172,7 +354,9 @@ class gpt3Extractor:
         """
         resultant_relation = {}
         try:
-            output = json.loads(output_str)
+            output = (
+                json.loads(output_str) if isinstance(output_str, str) else output_str
+            )
             resultant_relation["subj"] = output[
                 SUBJ_OBJ_REQUIRED_ENTITIES[self.r]["SUBJ"][0].strip()
             ]
@@ -209,10 +393,45 @@ class gpt3Extractor:
             ):
                 resultant_relation = None
         except Exception:
-            print(f"Error parsing GPT-3 output: {output_str}")
+            log.warning(f"Error parsing GPT-3 output: {output_str}")
             resultant_relation = None
         return resultant_relation
 
+    def parse_packed_gpt_output(
+        self, output_str: Optional[str], num_sentences: int
+    ) -> Optional[Dict[int, Optional[Dict]]]:
+        """
+        Parse the output of GPT-3 for a packed prompt
+        Parameters:
+            output_str: the output of GPT-3, a JSON array such as
+                        '[{"INDEX": 1, "PERSON": "John Doe", "ORGANIZATION": "Google", "RELATION": "Work_For"}, {"INDEX": 2}]'
+            num_sentences: the number of sentences in the prompt
+        Returns:
+            outputs: {position: relation} for each sentence answered (position from 0), the
+                     relation as returned by parse_gpt_output (None if there is none);
+                     the sentences the output leaves out are missing
+            If the output is not a well-formed array of objects with distinct indices, return None
+        """
+        try:
+            items = json.loads(output_str)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(items, list):
+            return None
+        outputs: Dict[int, Optional[Dict]] = {}
+        for item in items:
+            if not isinstance(item, dict):
+                return None
+            index = item.pop("INDEX", None)
+            if not isinstance(index, int) or not 1 <= index <= num_sentences:
+                return None
+            if index - 1 in outputs:
+                # Two answers for one sentence: which one is meant is unknown.
+                return None
+            # Sentences without the relation come back as a bare {"INDEX": n}.
+            outputs[index - 1] = self.parse_gpt_output(item) if item else None
+        return outputs
+
     def extract_entity_relations(self, sentence):
         """
         Extract entity relations
@@ -225,24 +444,61 @@ class gpt3Extractor:
         relation = self.gpt3_complete(prompt)
         return relation
 
-    def gpt3_complete(self, prompt):
+    def gpt3_complete(self, prompt, max_tokens=GPT3_PARAMS["max_tokens"]):
         """
         Use GPT-3 to complete a prompt
         Parameters:
             prompt: the prompt to complete
+            max_tokens: the maximum length of the completion
+        Returns:
+            completion: the completion of the prompt, or None if the request failed
+                        (or, in replay mode, if the completion was not recorded)
+        """
+        if self.completion_cache is not None:
+            params = dict(GPT3_PARAMS, max_tokens=max_tokens)
+            key = self.completion_cache.key(GPT3_MODEL, prompt, params)
+            text = self.completion_cache.getCompletion(key)
+            if text is not None:
+                return text
+        if self.replay:
+            log.warning("        Completion not found in the replay corpus; no relation")
+            return None
+        return self.dispatcher.call(prompt, max_tokens)
+
+    def gpt3_complete_packed(self, prompt):
+        """
+        Use GPT-3 to complete a packed prompt, leaving room for one answer per sentence
+        """
+        return self.gpt3_complete(prompt, PACKED_TOKENS_PER_SENTENCE * self.pack)
+
+    def request_completion(self, prompt, max_tokens):
+        """
+        Send one completion request to the OpenAI API and cache the answer.
+        Called by the dispatcher, under its rate limits.
+        Parameters:
+            prompt: the prompt to complete
+            max_tokens: the maximum length of the completion
         Returns:
             completion: the completion of the prompt
         """
+        params = dict(GPT3_PARAMS, max_tokens=max_tokens)
+        endpoint = {"api_base": self.api_base} if self.api_base else {}
+        started = time.perf_counter()
         completion = openai.Completion.create(
-            engine="text-davinci-003",
+            engine=GPT3_MODEL,
             prompt=prompt,
-            max_tokens=100,
-            temperature=0.2,
-            top_p=1,
-            frequency_penalty=0.0,
-            presence_penalty=0.0,
+            api_key=self.openai_key,
+            **endpoint,
+            **params,
         )
-        return completion["choices"][0]["text"]
+        text = completion["choices"][0]["text"]
+        if self.completion_cache is not None:
+            self.completion_cache.putCompletion(
+                self.completion_cache.key(GPT3_MODEL, prompt, params),
+                text,
+                time.perf_counter() - started,
+            )
+        return text
 
     def construct_prompt(self, sentence):
         """
@@ -257,3 +513,25 @@ class gpt3Extractor:
         sentence = f"Input: {sentence} Output:"
 
         return seed + example + sentence
+
+    def construct_packed_prompt(self, sentences):
+        """
+        Construct a prompt asking GPT-3 for the relations of several sentences at once.
+        The instructions and the example are only paid for once per prompt.
+        Parameters:
+            sentences: the candidate sentences to extract relations from
+        Returns:
+            prompt: a string to be passed to GPT-3
+        """
+        seed = f"In each of the given sentences, find relations where {PROMPT_AIDS[self.r]}"
+        example = f"Example Input: '{SEED_SENTENCES[self.r]}' Example Output: {SEED_PROMPTS[self.r]}."
+        instructions = (
+            " Answer with a JSON array holding one object per input sentence, formatted like"
+            ' the example output plus an "INDEX" key set to the sentence number.'
+            ' For a sentence without such a relation, output only {"INDEX": <number>}.'
+        )
+        inputs = " ".join(
+            f"Input {i}: {sentence}" for i, sentence in enumerate(sentences, start=1)
+        )
+
+        return seed + example + instructions + f" {inputs} Output:"
@@ -2,17 +2,34 @@
 Query Executor class and methods
 """
 # import pprint
-import re
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
 
 import requests
-from bs4 import BeautifulSoup
-from googleapiclient.discovery import build
 from prettytable import PrettyTable
 
-from GPT3Extractor import gpt3Extractor
+from lib import checkpoint
+from lib.cache import CompletionCache, PageCache, SearchCache, SentenceStore
+from lib.dedup import NearDuplicateIndex, canonical_url
+from lib.fetcher import PageFetcher
+from lib.frontier import URLFrontier
+from lib.htmltext import stream_paragraph_text
+from lib.log import getLogger
+from lib.metrics import Metrics
+from lib.normalize import TextNormalizer
+from lib.pipeline import ExtractionPipeline
+from lib.sink import RelationSink
 from lib.utils import RELATIONS
-from SpanBertExtractor import spanBertExtractor
+from lib.workers import ShardedExtraction
+
+log = getLogger("executor")
+
+# Webpage text is trimmed to this many characters; downloads stop once it is reached.
+MAX_PAGE_CHARS = 10000
+
+# The extractor modules (spaCy, torch, SpanBERT, openai) and the Google API
+# client are imported lazily: only the backend that was asked for is loaded.
 
 # HTML tags that we want to extract text from.
 
@@ -20,9 +37,20 @@ from SpanBertExtractor import spanBertExtractor
 class QueryExecutor:
     "Creates a QueryExecutor object"
 
-    def __init__(self, args) -> None:
+    def __init__(
+        self,
+        args,
+        models: Optional[Dict] = None,
+        worker_models: Optional[Callable[[], Dict]] = None,
+    ) -> None:
         """
         Initialize a QueryExecutor object
+        Parameters:
+            args: the parsed command line arguments
+            models: already loaded models to share, e.g. by the extraction server
+                    {"nlp": spaCy pipeline, "spanbert": SpanBERT model}
+            worker_models: a picklable function building the models of each -processes
+                           worker, in the worker (None: workers load their own)
         Instance Variables:
             query: the query string
             r: the relation to extract
@@ -32,12 +60,40 @@ class QueryExecutor:
             gpt3: whether or not to use GPT-3
             google_engine_id: the Google Custom Search Engine ID
             openai_secret_key: the OpenAI Secret Key
-            engine: the Google Custom Search Engine
-            seen_urls: the set of URLs that we have already seen
+            engines: the Google Custom Search Engine of each thread (built on its first live search)
+            replay: if True, searches and pages only come from the cache; no network access
+            seen_urls: the set of canonical URLs that we have already seen
+            url_frontier: the URLs found but not processed yet, by priority
+            urls_per_iteration: the number of URLs taken from the frontier in each iteration
+            duplicate_urls: the number of search results skipped as variants of a seen URL
             used_queries: the set of queries that we have already used
-            extractor: the extractor object (either SpanBERTExtractor or GPT-3Extractor)
+            frontier: the number of queries issued together in each iteration
+            queries: the queries of the current iteration and their confidence [(query, confidence)]
+            spacy_batch: the number of pages annotated together by spaCy
+            extractor: the extractor object (either SpanBERTExtractor or GPT-3Extractor),
+                       loaded on first use or in the background by startLoading
+            startup_times: a dictionary of startup step durations {step: seconds}
+            fetcher: the concurrent page fetcher
+            max_page_bytes: the maximum number of bytes downloaded per webpage
+            normalizer: collapses whitespace and strips invisible characters of webpage text
+            near_duplicates: the MinHash index of the pages processed (None if disabled)
+            page_cache: the persistent cache of webpage text (None if disabled)
+            search_cache: the persistent cache of search results (None if disabled)
+            sentence_store: the persistent extraction results of sentences (None if disabled)
+            pipeline: the staged extraction pipeline (None unless mode is "pipeline")
+            metrics: the stage timings and counters written at the end of the run
+                     (None unless -metrics is given; nothing is instrumented then)
+            sharded: the worker processes sharing the pages of each iteration
+                     (None unless -processes is above 1)
+            relation_sink: the file relations are streamed to as they are extracted
+                           (None unless -relations-out is given)
+            iterations: the number of iterations completed, including those of a resumed run
+            restored_relations: the relations of the checkpoint resumed from, added to
+                                the extractor when it is loaded (None if not resuming)
+                                [((subj, obj), confidence)] (no confidence for GPT-3)
         """
 
+        started = time.perf_counter()
         self.q = args.q
         self.r = args.r
         self.t = args.t
@@ -47,14 +103,175 @@ class QueryExecutor:
         self.custom_search_key = args.custom_search_key
         self.google_engine_id = args.google_engine_id
         self.openai_secret_key = args.openai_secret_key
-        self.engine = build("customsearch", "v1", developerKey=args.custom_search_key)
+        # googleapiclient services are not thread-safe: one per search thread.
+        self.engines = threading.local()
+        self.replay = args.replay
         self.seen_urls = set()
+        self.url_frontier = URLFrontier()
+        self.urls_per_iteration = args.urls_per_iteration
+        self.duplicate_urls = 0
         self.used_queries = set([self.q])
-        self.extractor = (
-            gpt3Extractor(r=self.r, openai_key=self.openai_secret_key)
-            if self.gpt3
-            else spanBertExtractor(r=self.r, t=self.t)
+        self.frontier = args.frontier
+        self.queries: List[Tuple[str, float]] = [(self.q, 1.0)]
+        self.spacy_batch = args.spacy_batch
+        # A replay corpus is used as recorded: nothing in it expires.
+        cache_ttl = args.cache_ttl if not self.replay else None
+        search_ttl = args.search_ttl if not self.replay else None
+        max_bytes = (
+            int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb is not None else None
+        )
+        self.args = args
+        self.models = models or {}
+        self.max_bytes = max_bytes
+        self.startup_times: Dict[str, float] = {}
+        self._extractor = None
+        self.extractor_lock = threading.Lock()
+        self.preload_thread: Optional[threading.Thread] = None
+        self.fetcher = PageFetcher(concurrency=args.concurrency, per_host=args.per_host)
+        self.max_page_bytes = args.max_page_kb * 1024
+        self.normalizer = TextNormalizer()
+        self.near_duplicates = (
+            NearDuplicateIndex(args.dedup_threshold) if args.dedup_threshold else None
+        )
+        self.page_cache = (
+            PageCache(
+                args.cache,
+                ttl=cache_ttl * 3600 if cache_ttl is not None else None,
+                max_bytes=max_bytes,
+            )
+            if args.cache
+            else None
+        )
+        self.search_cache = (
+            SearchCache(
+                args.cache,
+                ttl=search_ttl * 3600 if search_ttl is not None else None,
+                max_bytes=max_bytes,
+            )
+            if args.cache
+            else None
+        )
+        self.sentence_store = (
+            SentenceStore(args.cache, max_bytes=max_bytes)
+            if args.sentence_store
+            else None
+        )
+        self.pipeline = (
+            ExtractionPipeline(
+                self, queue_depth=args.queue_depth, batch_size=args.spacy_batch
+            )
+            if args.mode == "pipeline"
+            else None
+        )
+        self.metrics = Metrics() if args.metrics else None
+        if self.metrics is not None:
+            self.metrics.instrumentExecutor(self)
+        # The coordinating process extracts too: it starts processes - 1 workers.
+        self.sharded = (
+            ShardedExtraction(self, args.processes - 1, models=worker_models)
+            if args.processes > 1
+            else None
+        )
+        self.iterations = 0
+        self.restored_relations = None
+        if args.resume:
+            self.resume()
+        self.relation_sink = (
+            RelationSink(args.relations_out, args.relations_format, append=args.resume)
+            if args.relations_out
+            else None
+        )
+        self.startup_times["executor init"] = time.perf_counter() - started
+
+    @property
+    def extractor(self):
+        """
+        The extractor object, loaded on first access unless startLoading already did
+        """
+        if self._extractor is None:
+            self.loadExtractor()
+        return self._extractor
+
+    def startLoading(self) -> None:
+        """
+        Load the extractor in a background thread, e.g. while the first search
+        request is in flight.
+        Parameters:
+            None
+        Returns:
+            None
+        """
+        self.preload_thread = threading.Thread(
+            target=self.loadExtractor, name="preload", daemon=True
         )
+        self.preload_thread.start()
+        return
+
+    def loadExtractor(self) -> None:
+        """
+        Import the chosen backend's module and construct its extractor.
+        Safe to call from several threads: the extractor is only built once.
+        Parameters:
+            None
+        Returns:
+            None
+        """
+        with self.extractor_lock:
+            if self._extractor is not None:
+                return
+            args = self.args
+            if self.gpt3:
+                started = time.perf_counter()
+                from GPT3Extractor import gpt3Extractor
+
+                self.startup_times["import extractor"] = time.perf_counter() - started
+                started = time.perf_counter()
+                self._extractor = gpt3Extractor(
+                    r=self.r,
+                    openai_key=self.openai_secret_key,
+                    fast_sentences=args.fast_sentences,
+                    n_process=args.spacy_procs,
+                    # Without -cache, completions are still memoized for this run.
+                    completion_cache=CompletionCache(
+                        args.cache or ":memory:",
+                        max_bytes=self.max_bytes,
+                        lru_size=args.completion_lru,
+                    ),
+                    workers=args.llm_workers,
+                    rpm=args.llm_rpm,
+                    tpm=args.llm_tpm,
+                    api_base=args.openai_base,
+                    pack=args.pack,
+                    nlp=self.models.get("nlp"),
+                    sentence_store=self.sentence_store,
+                    replay=self.replay,
+                )
+            else:
+                started = time.perf_counter()
+                from SpanBertExtractor import spanBertExtractor
+
+                self.startup_times["import extractor"] = time.perf_counter() - started
+                started = time.perf_counter()
+                self._extractor = spanBertExtractor(
+                    r=self.r,
+                    t=self.t,
+                    fast_sentences=args.fast_sentences,
+                    n_process=args.spacy_procs,
+                    batch_size=args.spanbert_batch,
+                    nlp=self.models.get("nlp"),
+                    spanbert=self.models.get("spanbert"),
+                    sentence_store=self.sentence_store,
+                    backend=args.spanbert_backend,
+                )
+            self.startup_times["load models"] = time.perf_counter() - started
+            if self.restored_relations is not None:
+                for row in self.restored_relations:
+                    self._extractor.relations.upsert(*row)
+                self.restored_relations = None
+            self._extractor.sink = self.relation_sink
+            if self.metrics is not None:
+                self.metrics.instrumentExtractor(self._extractor)
+        return
 
     def printQueryParams(self) -> None:
         """
@@ -82,11 +299,30 @@ class QueryExecutor:
     def getQueryResult(self, query: str, k) -> List:
         """
         Get the top 10 results for a given query from Google Custom Search API
+        Results are answered from the search cache when possible.
         Source: https://github.com/googleapis/google-api-python-client/blob/main/samples/customsearch/main.py
         """
+        if self.search_cache is not None:
+            items = self.search_cache.getResults(query, self.google_engine_id)
+            if items is not None:
+                return items[0:k]
+        if self.replay:
+            log.warning(f"Query not found in the replay corpus: {query}")
+            return []
+
+        engine = getattr(self.engines, "engine", None)
+        if engine is None:
+            started = time.perf_counter()
+            from googleapiclient.discovery import build
 
+            engine = self.engines.engine = build(
+                "customsearch", "v1", developerKey=self.custom_search_key
+            )
+            self.startup_times.setdefault(
+                "search client", time.perf_counter() - started
+            )
         full_res = (
-            self.engine.cse()
+            engine.cse()
             .list(
                 q=query,
                 cx=self.google_engine_id,
@@ -94,76 +330,284 @@ class QueryExecutor:
             .execute()
         )
 
-        return full_res["items"][0 : k + 1]
+        items = full_res["items"]
+        if self.search_cache is not None:
+            self.search_cache.putResults(query, self.google_engine_id, items)
+        return items[0:k]
 
-    def processText(self, url: str) -> Optional[str]:
+    def searchQueries(self, k) -> List[Tuple[float, List[Dict]]]:
         """
-        Get the tokens from a given URL
-        If webpage retrieval fails (e.g. because of a timeout), it is skipped (None returned)
+        Get the results of all queries of the current iteration, searched concurrently
+        Parameters:
+            k - the number of results per query (as for getQueryResult)
+        Returns:
+            the confidence of each query and its result items [(confidence, items)]
+        """
+        if len(self.queries) == 1:
+            query, confidence = self.queries[0]
+            return [(confidence, self.getQueryResult(query, k))]
+        searches = [
+            self.fetcher.pool.submit(self.getQueryResult, query, k)
+            for query, _confidence in self.queries
+        ]
+        return [
+            (confidence, search.result())
+            for (_query, confidence), search in zip(self.queries, searches)
+        ]
 
-        Extracts the plain text from the URL using Beautiful Soup.
-        If the resulting plain text is longer than 10,000 characters, it is truncated.
-        Only the text in the <p> tags is processed.
+    def fetchPage(self, session, url: str) -> Optional[str]:
+        """
+        Download a given URL and extract the normalized text in its <p> tags
+        while streaming. Downloading stops once 10,000 characters of text are
+        collected or the body exceeds the maximum page size.
+        If webpage retrieval fails (e.g. because of a timeout), it is skipped (None returned)
 
         Parameters:
-            url (str) - the URL to process
+            session - the requests session (or the requests module) used for the download
+            url (str) - the URL to fetch
         Returns:
-            List[str] - the list of tokens
+            str - the normalized paragraph text, or None on failure
         """
-
         try:
-            print("        Fetching text from url ...")
-            page = requests.get(url, timeout=5)
+            with session.get(url, timeout=5, stream=True) as page:
+                text, read = stream_paragraph_text(
+                    page, MAX_PAGE_CHARS, self.max_page_bytes, normalizer=self.normalizer
+                )
+            if self.metrics is not None:
+                self.metrics.add("bytes_total", read, stage="fetch")
+            return text
         except requests.exceptions.Timeout:
-            print(f"Error processing {url}: The request timed out. Moving on...")
+            log.warning(f"Error processing {url}: The request timed out. Moving on...")
+            return None
+        except Exception as e:
+            log.warning(f"Error processing {url}: {e}. Moving on ...")
             return None
-        try:
-            soup = BeautifulSoup(page.content, "html.parser")
-            html_blocks = soup.find_all("p")
-            text = ""
-            for block in html_blocks:
-                text += block.get_text()
-
-            if text != "":
-                text_len = len(text)
-                print(
-                    f"        Trimming webpage content from {text_len} to 10000 characters"
-                )
-                preprocessed_text = (text[:10000]) if text_len > 10000 else text
-                print(
-                    f"        Webpage length (num characters): {len(preprocessed_text)}"
-                )
-                # Removing redundant newlines and some whitespace characters.
-                preprocessed_text = re.sub("\t+", " ", preprocessed_text)
-                preprocessed_text = re.sub("\n+", " ", preprocessed_text)
-                preprocessed_text = re.sub(" +", " ", preprocessed_text)
-                preprocessed_text = preprocessed_text.replace("\u200b", "")
 
-                return preprocessed_text
-            else:
+    def loadPage(self, session, url: str) -> Tuple[Optional[str], bool]:
+        """
+        Get a page's text from the page cache, or download it on a cache miss.
+        Parameters:
+            session - the requests session (or the requests module) used for the download
+            url (str) - the URL to load
+        Returns:
+            (text, cached) - text is the preprocessed text if cached is True,
+                             else the normalized paragraph text (None if the download failed)
+        """
+        if self.page_cache is not None:
+            text = self.page_cache.getText(url)
+            if text is not None:
+                return text, True
+        if self.replay:
+            log.warning(f"Error processing {url}: not in the replay corpus. Moving on ...")
+            return None, False
+        return self.fetchPage(session, url), False
+
+    def extractText(self, url: str, page: Tuple[Optional[str], bool]) -> Optional[str]:
+        """
+        Get the preprocessed text of a page loaded by loadPage.
+        Text of downloaded pages is stored in the page cache. Pages that are near
+        duplicates of a page already processed in this run are skipped.
+        Pages without text are recorded in the URL frontier as giving no relations.
+
+        Parameters:
+            url (str) - the URL the page was loaded from
+            page (tuple) - (text, cached) as returned by loadPage
+        Returns:
+            str - the preprocessed text, or None if there is nothing to process
+        """
+        text = self.pageText(url, page)
+        if text is None:
+            # Pages without text count against their host's yield.
+            self.url_frontier.record(url, 0)
+        return text
+
+    def pageText(self, url: str, page: Tuple[Optional[str], bool]) -> Optional[str]:
+        """
+        The preprocessed text of a page for extractText, or None
+        """
+        text, cached = page
+        if cached:
+            log.debug("        Using cached webpage text")
+            preprocessed_text = text or None
+        elif text is None:
+            return None
+        else:
+            preprocessed_text = self.preprocessText(text)
+            if self.page_cache is not None:
+                self.page_cache.putText(url, preprocessed_text or "")
+        if preprocessed_text and self.near_duplicates is not None:
+            duplicate = self.near_duplicates.check(url, preprocessed_text)
+            if duplicate is not None:
+                log.info(
+                    f"        Skipping near-duplicate of {duplicate[0]} (similarity {duplicate[1]:.2f})"
+                )
                 return None
-        except Exception as e:
-            print(f"Error processing {url}: {e}. Moving on ...")
+        return preprocessed_text
+
+    def preprocessText(self, text: str) -> Optional[str]:
+        """
+        Trims the text of a webpage to 10,000 characters and removes redundant whitespace.
+        Text normalized while streaming is unchanged by normalizing again (nothing matches).
+
+        Parameters:
+            text (str) - the text in the <p> tags of the webpage
+        Returns:
+            str - the preprocessed text, or None if there is nothing to process
+        """
+        if text != "":
+            # Normalize before trimming, so that the 10,000 characters kept are
+            # 10,000 characters of normalized text.
+            preprocessed_text = self.normalizer.normalize(text)
+            text_len = len(preprocessed_text)
+            log.debug(
+                f"        Trimming webpage content from {text_len} to {MAX_PAGE_CHARS} characters"
+            )
+            preprocessed_text = (
+                (preprocessed_text[:MAX_PAGE_CHARS])
+                if text_len > MAX_PAGE_CHARS
+                else preprocessed_text
+            )
+            log.debug(f"        Webpage length (num characters): {len(preprocessed_text)}")
+
+            return preprocessed_text or None
+        else:
             return None
 
+    def processText(self, url: str) -> Optional[str]:
+        """
+        Get the preprocessed text from a given URL, fetching it synchronously.
+        If webpage retrieval fails (e.g. because of a timeout), it is skipped (None returned)
+
+        Parameters:
+            url (str) - the URL to process
+        Returns:
+            str - the preprocessed text, or None
+        """
+        log.debug("        Fetching text from url ...")
+        return self.extractText(url, self.loadPage(requests, url))
+
     def parseResult(self, result: Dict[str, str]) -> None:
         """
         Parse the result of a query.
-        Exposed function for use by main function.
         Parameters:
             result (dict) - one item as returned as the result of a query
         Returns:
             None
         """
         url = result["link"]
-        if url not in self.seen_urls:
-            self.seen_urls.add(url)
+        key = canonical_url(url)
+        if key not in self.seen_urls:
+            self.seen_urls.add(key)
             text = self.processText(url)
             if not text:
                 return None
             self.extractor.get_relations(text)
         return
 
+    def parseResults(self, batches: List[Tuple[float, List[Dict[str, str]]]]) -> bool:
+        """
+        Parse the results of an iteration's queries.
+        Exposed function for use by main function.
+        Unseen URLs are added to the URL frontier, then the highest scoring
+        URLs of the frontier are fetched concurrently, and each page is handed
+        to the extractor as soon as its download completes. Outstanding fetches
+        are cancelled once k tuples have been extracted, and the URLs left
+        unprocessed go back to the frontier (a resumed run with a larger k gets to them).
+        In "pipeline" mode, parsing and spaCy annotation also run on their own
+        threads, overlapping with fetching and relation extraction.
+        With -processes above 1, the pages are shared between worker processes instead.
+        Parameters:
+            batches (list) - the confidence of each query and the items it returned
+        Returns:
+            bool (True if we need to find more relations, else False)
+        """
+        for confidence, results in batches:
+            for rank, item in enumerate(results):
+                url = item["link"]
+                # Variants of a URL already seen (scheme, "www."/mobile/AMP hosts,
+                # tracking parameters, ...) are not fetched again.
+                key = canonical_url(url)
+                if key not in self.seen_urls:
+                    self.seen_urls.add(key)
+                    self.url_frontier.push(key, url, rank, confidence)
+                else:
+                    self.duplicate_urls += 1
+                    if key in self.url_frontier:
+                        # Returned by another query too: raise its priority.
+                        self.url_frontier.push(key, url, rank, confidence)
+        urls = self.url_frontier.pop(self.urls_per_iteration)
+        ranks = {url: i for i, url in enumerate(urls)}
+        try:
+            return self.processURLs(ranks, len(urls))
+        finally:
+            requeued = self.url_frontier.requeue()
+            if requeued:
+                log.info(f"{requeued} unprocessed URLs of the iteration put back in the frontier")
+
+    def processURLs(self, ranks: Dict[str, int], num_results: int) -> bool:
+        """
+        Process the URLs of an iteration in the configured mode
+        Parameters:
+            ranks (dict) - the iteration's URLs and their position {url: position}
+            num_results (int) - the number of URLs in the iteration
+        Returns:
+            bool (True if we need to find more relations, else False)
+        """
+        if self.sharded:
+            return self.sharded.run(ranks, num_results)
+        if self.pipeline:
+            return self.pipeline.run(ranks, num_results)
+
+        pages = self.fetcher.fetchAll(ranks, self.loadPage)
+        pending = []
+        try:
+            for url, page in pages:
+                log.info(f"URL ( {ranks[url] + 1} / {num_results}): {url}")
+                text = self.extractText(url, page)
+                if text:
+                    pending.append((url, text))
+                if len(pending) >= self.spacy_batch:
+                    if not self.extractBatch(pending):
+                        return False
+                    pending = []
+        finally:
+            pages.close()
+        if pending:
+            return self.extractBatch(pending)
+        return self.checkContinue()
+
+    def extractBatch(self, pages: List[Tuple[str, str]]) -> bool:
+        """
+        Annotate a batch of webpages with spaCy, then extract relations from each.
+        Parameters:
+            pages (list) - the URL and preprocessed text of each webpage
+        Returns:
+            bool (True if we need to find more relations, else False)
+        """
+        if len(pages) == 1:
+            docs = [self.extractor.annotate(pages[0][1])]
+        else:
+            docs = self.extractor.annotate_batch([text for _url, text in pages])
+        for (url, _text), doc in zip(pages, docs):
+            self.extractDoc(url, doc)
+            if not self.checkContinue():
+                return False
+        return True
+
+    def extractDoc(self, url: str, doc) -> None:
+        """
+        Extract relations from an annotated webpage and credit the new ones to its host
+        Parameters:
+            url (str) - the URL of the webpage
+            doc - the spaCy document of the webpage
+        Returns:
+            None
+        """
+        before = len(self.extractor.relations)
+        self.extractor.get_relations_from_doc(doc)
+        self.url_frontier.record(url, len(self.extractor.relations) - before)
+        return
+
     def checkContinue(self) -> bool:
         """
         Evaluate if we have evaluated at least k tuples, ie continue or halt.
@@ -174,9 +618,10 @@ class QueryExecutor:
 
     def getNewQuery(self) -> Optional[str]:
         """
-        Creates a new query.
-        Select from X a tuple y such that y has not been used for querying yet
-        Create a query q from tuple y by concatenating
+        Creates the queries of the next iteration.
+        Select from X the tuples y that have not been used for querying yet
+        (up to -frontier of them, highest confidence first for SpanBERT)
+        Create a query q from each tuple y by concatenating
         the attribute values together.
         If no such y tuple exists, then stop/return None.
         (ISE has "stalled" before retrieving k high-confidence tuples.)
@@ -184,51 +629,166 @@ class QueryExecutor:
         Parameters:
             None
         Returns:
-            query (str) if available; else None
+            query (str), the first query of the iteration, if available; else None
         """
-        if self.gpt3:
-            # Iterating through extracted tuples
-            for relation in list(self.extractor.relations):
-                # Constructing query
-                if self.gpt3:
-                    tmp_query = " ".join(relation)
-                # Checking if query has been used
-                if tmp_query not in self.used_queries:
-                    # Adding query to used queries
-                    self.used_queries.add(relation)
-                    # Setting new query
-                    self.q = tmp_query
-                    return self.q
-            # No valid query found
+        queries = self.getNewQueries(self.frontier)
+        if not queries:
+            # No valid query found; URLs still in the frontier can be processed without one.
+            self.queries = []
             return None
+        self.queries = queries
+        self.q = queries[0][0]
+        return self.q
+
+    def getNewQueries(self, n: int) -> List[Tuple[str, float]]:
+        """
+        Select up to n unused tuples and mark their queries as used
+        Parameters:
+            n - the maximum number of queries
+        Returns:
+            a list of (query, confidence); GPT-3 tuples all have confidence 1
+        """
+        # The relation store hands out unused tuples by confidence, highest first
+        # (GPT-3 tuples in extraction order); tuples whose query was already
+        # issued (e.g. the seed query) are skipped and not offered again.
+        queries = []
+        for subj_obj, confidence in self.extractor.relations.takeUnused(
+            n, accept=lambda subj_obj: " ".join(subj_obj) not in self.used_queries
+        ):
+            tmp_query = " ".join(subj_obj)
+            # Adding query to used queries
+            self.used_queries.add(tmp_query)
+            queries.append((tmp_query, float(confidence)))
+        return queries
 
-        elif self.spanbert:
-            # Sort by tuples by confidence
-            rels = sorted(
-                self.extractor.relations.items(), key=lambda item: item[1], reverse=True
+    def checkpointState(self) -> Dict:
+        """
+        Returns: the run's state at the end of an iteration, JSON-serializable
+        """
+        if self.gpt3:
+            relations = [list(relation) for relation in self.extractor.relations]
+        else:
+            relations = [
+                [subj, obj, float(confidence)]
+                for (subj, obj), confidence in self.extractor.relations.items()
+            ]
+        return {
+            "method": "gpt3" if self.gpt3 else "spanbert",
+            "r": self.r,
+            "iterations": self.iterations,
+            "q": self.q,
+            "queries": [[query, confidence] for query, confidence in self.queries],
+            "used_queries": sorted(self.used_queries),
+            "seen_urls": sorted(self.seen_urls),
+            "duplicate_urls": self.duplicate_urls,
+            "url_frontier": self.url_frontier.state(),
+            "relations": relations,
+        }
+
+    def saveCheckpoint(self, force: bool = False) -> None:
+        """
+        Write a checkpoint after every -checkpoint-every iterations (if -checkpoint is given)
+        Parameters:
+            force - write it whatever the iteration, e.g. at the end of the run
+        Returns:
+            None
+        """
+        if not self.args.checkpoint:
+            return
+        if not force and self.iterations % self.args.checkpoint_every:
+            return
+        checkpoint.save(self.args.checkpoint, self.checkpointState())
+        return
+
+    def resume(self) -> None:
+        """
+        Restore the state of the run saved in the -checkpoint file. Its URLs are
+        not fetched again and its queries are not reused.
+        Parameters:
+            None
+        Returns:
+            None
+        """
+        state = checkpoint.load(self.args.checkpoint)
+        method = "gpt3" if self.gpt3 else "spanbert"
+        if (state["method"], state["r"]) != (method, self.r):
+            raise ValueError(
+                f"{self.args.checkpoint} is a checkpoint of a -{state['method']} run for "
+                f"relation {state['r']}, not -{method} for relation {self.r}"
             )
-            # TODO: remove after testing
-            # pp = pprint.PrettyPrinter(indent=4)
-            # pp.pprint(rels)
-
-            queryNotFound = True
-            i = 0
-            while queryNotFound:
-                # No valid query found
-                if i >= len(rels):
-                    return None
-                subj_obj, _pred = rels[i]
-                tmp_query = " ".join(subj_obj)
-
-                # Checking if query has been used
-                if tmp_query not in self.used_queries:
-                    queryNotFound = False
-                    # Adding query to used queries
-                    self.used_queries.add(tmp_query)
-                    # Setting new query
-                    self.q = tmp_query
-                    return self.q
-                i += 1
+        self.iterations = state["iterations"]
+        self.q = state["q"]
+        self.queries = [(query, confidence) for query, confidence in state["queries"]]
+        self.used_queries = set(state["used_queries"])
+        self.seen_urls = set(state["seen_urls"])
+        self.duplicate_urls = state["duplicate_urls"]
+        self.url_frontier.restore(state["url_frontier"])
+        self.restored_relations = [
+            ((relation[0], relation[1]), *relation[2:]) for relation in state["relations"]
+        ]
+        log.info(
+            f"Resuming after iteration {self.iterations}: {len(state['relations'])} relations,"
+            f" {len(self.seen_urls)} URLs seen, {len(self.url_frontier)} URLs queued"
+        )
+        return
+
+    def printRunStats(self) -> None:
+        """
+        Print execution statistics gathered during the run
+        Parameters:
+            None
+        Returns:
+            None
+        """
+        print("================== Startup =================")
+        for step, seconds in self.startup_times.items():
+            print(f"{step:<18} {seconds:8.2f}s")
+        if self.pipeline:
+            self.pipeline.printStats()
+        if self.sharded:
+            self.sharded.printStats()
+        print("================== Domains =================")
+        print(self.url_frontier.report())
+        print("================== Sentences =================")
+        print(self.extractor.type_index.report())
+        print(self.extractor.sentence_index.report())
+        print("================== Duplicates =================")
+        print(f"duplicate URLs skipped: {self.duplicate_urls}")
+        if self.near_duplicates is not None:
+            print(self.near_duplicates.report())
+        if self.page_cache is not None:
+            print("================== Cache =================")
+            print(self.search_cache.report())
+            print(self.page_cache.report())
+            if self.sentence_store is not None:
+                print(self.sentence_store.report())
+        if self.gpt3:
+            print(self.extractor.completion_cache.report())
+        return
+
+    def close(self) -> None:
+        """
+        Release network connections and persist caches
+        Parameters:
+            None
+        Returns:
+            None
+        """
+        if self.metrics is not None:
+            self.metrics.collect(self)
+            self.metrics.write(self.args.metrics, self.args.metrics_format)
+        if self.sharded:
+            self.sharded.close()
+        if self.relation_sink is not None:
+            self.relation_sink.close()
+        self.fetcher.close()
+        if self.page_cache is not None:
+            self.page_cache.close()
+            self.search_cache.close()
+        if self.sentence_store is not None:
+            self.sentence_store.close()
+        if self.gpt3:
+            self.extractor.completion_cache.close()
         return
 
     def printRelations(self) -> None:
@@ -1,38 +1,70 @@
 "SpanBertPredictor class"
+import logging
 from typing import Dict, List, Tuple
 
-import spacy
-from spacy_help_functions import create_entity_pairs, get_entities
-from spanbert import SpanBERT
-
-from lib.utils import (
-    ENTITIES_OF_INTEREST,
-    SUBJ_OBJ_REQUIRED_ENTITIES,
-    TARGET_RELATION_PREDS,
-)
+from lib.backends import PRETRAINED_SPANBERT, load_spanbert, predict_batched
+from lib.dedup import SentenceIndex
+from lib.entities import RelationTypeIndex
+from lib.log import getLogger, logRelation
+from lib.nlp import annotate_batch, load_pipeline
+from lib.relations import RelationStore
+from lib.utils import TARGET_RELATION_PREDS
 
+log = getLogger("spanbert")
 # spacy.cli.download("en_core_web_sm")
 
 
 class spanBertExtractor:
-    def __init__(self, r, t, model="en_core_web_sm"):
+    def __init__(
+        self,
+        r,
+        t,
+        model="en_core_web_sm",
+        fast_sentences=False,
+        n_process=1,
+        batch_size=32,
+        nlp=None,
+        spanbert=None,
+        sentence_store=None,
+        backend="fp32",
+    ):
         """
         Initialize a spaCyExtractor object
         Parameters:
             r: the relation to extract
             model: the spaCy model to use
+            fast_sentences: split sentences with spaCy's senter instead of the parser
+            n_process: the number of processes used by annotate_batch
+            batch_size: the number of candidate pairs scored per SpanBERT call
+            nlp: an already loaded spaCy pipeline to share (loaded from model if None)
+            spanbert: an already loaded SpanBERT model to share (loaded if None)
+            sentence_store: a SentenceStore keeping sentence predictions across runs (None: this run only)
+            backend: the SpanBERT inference backend, "fp32" or "int8" (used if spanbert is None)
         Instance Variables:
             nlp: the spaCy model
+            type_index: the subject/object entity types of the relation
+            sentence_index: the predictions of every sentence already scored
             total_extracted: the total number of relations extracted
-            self.relations: a dictionary of relations and their confidence
+            self.relations: a RelationStore of relations and their confidence
                             {(subj, obj): confidence}
+            sink: the RelationSink relations are written to as they pass the threshold (None: off)
         """
-        self.nlp = spacy.load(model)
-        self.spanbert = SpanBERT("./SpanBERT/pretrained_spanbert")
+        self.nlp = nlp if nlp is not None else load_pipeline(model, fast_sentences)
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self.spanbert = spanbert if spanbert is not None else load_spanbert(backend)
         self.r = r
         self.t = t
+        self.type_index = RelationTypeIndex(r)
+        # Predictions depend on the checkpoint and backend: an int8 run must not
+        # reuse the fp32 predictions of a -sentence-store, nor the other way round.
+        checkpoint = PRETRAINED_SPANBERT.rstrip("/").rsplit("/", 1)[-1]
+        self.sentence_index = SentenceIndex(
+            f"spanbert:{checkpoint}:{backend}:{r}", sentence_store
+        )
         self.total_extracted = 0
-        self.relations = {}
+        self.relations = RelationStore()
+        self.sink = None
 
     def extract_candidate_pairs(self, doc):
         """
@@ -49,43 +81,83 @@ class spanBertExtractor:
         num_sents = len(list(doc.sents))
         extracted_sentences = 0
         extracted_annotations = 0
-        print(
+        sentence_candidates = []
+        # Per sentence, in order: (sentence, fingerprint, candidates, results).
+        # Sentences already processed have no candidates; their results come
+        # from the sentence index.
+        plan = []
+        queued = set()
+        log.debug(
             f"        Extracted {num_sents} sentences. Processing each sentence one by one to check for presence of right pair of named entity types; if so, will run the second pipeline ..."
         )
 
         for i, sentence in enumerate(doc.sents):
             if i % 5 == 0 and i != 0:
-                print(f"        Processed {i} / {num_sents} sentences")
+                log.debug(f"        Processed {i} / {num_sents} sentences")
             # print("Processing sentence: {}".format(sentence))
             # print("Tokenized sentence: {}".format([token.text for token in sentence]))
-            ents = get_entities(sentence, ENTITIES_OF_INTEREST[self.r])
-            # This prints all the entities that spaCy extracts from the sentence.
-            # print("spaCy extracted entities: {}".format(ents))
 
-            # Create entity pairs.
-            sentence_entity_pairs = create_entity_pairs(
-                sentence, ENTITIES_OF_INTEREST[self.r]
-            )
-            # Filter out entity pairs that don't contain the required entities for the relations on a
-            # sentence-by-sentence basis. Keep track of the number of sentences that contain at least
-            # one entity pair that contains the required entities, as well as the total number of
-            # extracted relations for a given webpage.
-            candidates = self.filter_candidate_pairs(sentence_entity_pairs)
+            # Skip sentences whose entity labels cannot make up a pair of the right
+            # subject/object types for the relation (e.g. only Person:Organization for
+            # the "Work_For" relation) before any pair is built.
+            if not self.type_index.keep(sentence):
+                continue
+            # Sentences seen before (on this page, another page, or a previous run)
+            # reuse their predictions instead of being scored again.
+            fingerprint = self.sentence_index.fingerprint(sentence.text)
+            if fingerprint in queued:
+                # Repeated on this page: looked up once its first occurrence is scored.
+                plan.append((sentence, fingerprint, None, None))
+                continue
+            results = self.sentence_index.lookup(fingerprint)
+            if results is not None:
+                plan.append((sentence, fingerprint, None, results))
+                continue
+            # Create the entity pairs of the right types. Keep track of the number of
+            # sentences that contain at least one candidate pair, as well as the total
+            # number of extracted relations for a given webpage.
+            candidates = self.type_index.candidatePairs(sentence)
             if candidates == []:
+                self.sentence_index.add(fingerprint, [])
                 continue
+            queued.add(fingerprint)
+            plan.append((sentence, fingerprint, candidates, None))
+            sentence_candidates.append(candidates)
 
-            tokens = candidates[0]["tokens"]
-            relation_preds = self.extract_entity_relation_preds(candidates)
-            for ex, pred in list(relation_preds):
-                rel = (ex["subj"][0], ex["obj"][0])
-                self.check_relation_prediction(rel, pred, tokens)
+        # Score the candidates of every sentence together, then walk the
+        # predictions back sentence by sentence.
+        relation_preds = []
+        if sentence_candidates:
+            relation_preds = self.extract_entity_relation_preds(
+                [c for candidates in sentence_candidates for c in candidates]
+            )
+        offset = 0
+        for sentence, fingerprint, candidates, results in plan:
+            if candidates is None:
+                if results is None:
+                    results = self.sentence_index.lookup(fingerprint)
+                tokens = [token.text for token in sentence]
+            else:
+                tokens = candidates[0]["tokens"]
+                sentence_preds = relation_preds[offset : offset + len(candidates)]
+                offset += len(candidates)
+                results = [
+                    [ex["subj"][0], ex["obj"][0], pred[0], float(pred[1])]
+                    for ex, pred in sentence_preds
+                ]
+                self.sentence_index.add(fingerprint, results)
+            if not results:
+                continue
+            for subj, obj, label, confidence in results:
+                self.check_relation_prediction((subj, obj), (label, confidence), tokens)
             extracted_sentences += 1
-            extracted_annotations += len(relation_preds)
+            extracted_annotations += len(results)
+        self.sentence_index.flush()
 
-        print(
+        log.info(
             f"Extracted annotations for  {extracted_sentences}  out of total  {num_sents}  sentences"
         )
-        print(
+        log.info(
             f"Relations extracted from this website: {extracted_annotations} (Overall: {len(self.relations)})"
         )
         return extracted_annotations
@@ -116,15 +188,18 @@ class spanBertExtractor:
         if pred[1] < self.t:
             return
 
-        # Check if the relation has already been seen.
-        if rel not in self.relations:
-            self.relations[rel] = pred[1]
+        # Check if the relation has already been seen; the store keeps the higher confidence.
+        previous = self.relations.upsert(rel, pred[1])
+        if previous is None:
+            if self.sink is not None:
+                self.sink.write(rel, pred[1])
             self.print_relation(rel, pred[1], tokens, duplicate=False)
         else:
-            if self.relations[rel] < pred[1]:
-                self.relations[rel] = pred[1]
+            if previous < pred[1]:
+                if self.sink is not None:
+                    self.sink.write(rel, pred[1], updated=True)
                 self.print_relation(rel, pred[1], tokens, duplicate=True, status="<")
-            elif self.relations[rel] > pred[1]:
+            elif previous > pred[1]:
                 self.print_relation(rel, pred[1], tokens, duplicate=True, status=">")
             else:
                 self.print_relation(rel, pred[1], tokens, duplicate=True, status="=")
@@ -135,7 +210,8 @@ class spanBertExtractor:
         self, relation, confidence, tokens, duplicate, status=None
     ) -> None:
         """
-        Print relation
+        Log relation: a compact record if it was added or raised in confidence,
+        and the full block (with the sentence's tokens) at the DEBUG level
         Parameters:
             relation: the relation to print
             confidence: the confidence of the relation
@@ -144,52 +220,34 @@ class spanBertExtractor:
         Returns:
             None
         """
-        print("                === Extracted Relation ===")
-        print(f"                Input tokens: {tokens}")
-        print(
-            f"                Output Confidence: {confidence} ; Subject: {relation[0]} ; Object: {relation[1]} ;"
-        )
+        if not duplicate or status == "<":
+            logRelation("spanbert", relation, confidence, updated=duplicate)
+        # Only build the block (and format the tokens) if it will be shown.
+        if not log.isEnabledFor(logging.DEBUG):
+            return
+        lines = [
+            "                === Extracted Relation ===",
+            f"                Input tokens: {tokens}",
+            f"                Output Confidence: {confidence} ; Subject: {relation[0]} ; Object: {relation[1]} ;",
+        ]
         if duplicate:
             if status == "<":
-                print(
+                lines.append(
                     "                Duplicate with higher confidence than existing record. Updating record."
                 )
 
             elif status == ">":
-                print(
+                lines.append(
                     "                Duplicate with lower confidence than existing record. Ignoring this."
                 )
             else:
-                print(
+                lines.append(
                     "                Duplicate with same confidence as existing record. Ignoring this."
                 )
-        print("                ==========")
+        lines.append("                ==========")
+        log.debug("\n".join(lines))
         return
 
-    def filter_candidate_pairs(self, sentence_entity_pairs):
-        # Create candidate pairs. Filter out subject-object pairs that
-        # aren't the right type for the target relation.
-        # (e.g. don't include anything that's not Person:Organization for the "Work_For" relation)
-        candidate_pairs = []
-        target_candidate_pairs = []
-        for ep in sentence_entity_pairs:
-            candidate_pairs.append(
-                {"tokens": ep[0], "subj": ep[1], "obj": ep[2]}
-            )  # e1=Subject, e2=Object
-            candidate_pairs.append(
-                {"tokens": ep[0], "subj": ep[2], "obj": ep[1]}
-            )  # e1=Object, e2=Subject
-
-        for p in candidate_pairs:
-            if (
-                p["subj"][1] in SUBJ_OBJ_REQUIRED_ENTITIES[self.r]["SUBJ"]
-                and p["obj"][1] in SUBJ_OBJ_REQUIRED_ENTITIES[self.r]["OBJ"]
-            ):
-                target_candidate_pairs.append(p)
-
-        # This info, formatted, should be printed in extract_candidate_pairs.
-        return target_candidate_pairs
-
     def get_relations(self, text: str) -> List[Tuple[str, str]]:
         """
         Exposed function to take in text and return named entities
@@ -198,13 +256,60 @@ class spanBertExtractor:
         Returns:
             entities: a list of tuples of the form (subject, object)
         """
-        doc = self.nlp(text)
-        print("        Annotating the webpage using spacy...")
+        return self.get_relations_from_doc(self.annotate(text))
+
+    def annotate(self, text: str):
+        """
+        Annotate text with spaCy
+        Parameters:
+            text: the text to annotate
+        Returns:
+            doc: the spaCy document
+        """
+        return self.nlp(text)
+
+    def annotate_batch(self, texts: List[str]) -> List:
+        """
+        Annotate several texts with spaCy in one batch
+        Parameters:
+            texts: the texts to annotate
+        Returns:
+            docs: the spaCy documents, in the same order as texts
+        """
+        return annotate_batch(self.nlp, texts, len(texts), self.n_process)
+
+    def get_relations_from_doc(self, doc) -> List[Tuple[str, str]]:
+        """
+        Extract relations from a document already annotated by spaCy
+        Parameters:
+            doc: the spaCy document to extract relations from
+        Returns:
+            entities: a list of tuples of the form (subject, object)
+        """
+        log.debug("        Annotating the webpage using spacy...")
         num_extracted_annotations = self.extract_candidate_pairs(doc)
         if len(self.relations) == 0:
-            print("No annotations found...")
+            log.debug("No annotations found...")
         return self.relations
 
+    def merge_relations(self, relations: List[Tuple[str, str, float]]) -> int:
+        """
+        Merge relations extracted elsewhere (e.g. by a worker process), keeping
+        the highest confidence of each
+        Parameters:
+            relations: a list of tuples of the form (subject, object, confidence)
+        Returns:
+            merged: the number of relations added or raised in confidence
+        """
+        merged = 0
+        for subj, obj, confidence in relations:
+            previous = self.relations.upsert((subj, obj), confidence)
+            if previous is None or previous < confidence:
+                if self.sink is not None:
+                    self.sink.write((subj, obj), confidence, updated=previous is not None)
+                merged += 1
+        return merged
+
     def extract_entity_relation_preds(
         self, candidate_pairs
     ) -> List[Tuple[Tuple[str, str], str]]:
@@ -216,13 +321,11 @@ class spanBertExtractor:
             zip(candidate_pairs, relation_pairs):
         """
         if len(candidate_pairs) == 0:
-            print("No candidate pairs found. Returning empty list.")
+            log.debug("No candidate pairs found. Returning empty list.")
             return []
 
         # get predictions: list of (relation, confidence) pairs
         # example: ('per:employee_of', 0.9832898),
-        relation_preds = self.spanbert.predict(candidate_pairs)
+        relation_preds = predict_batched(self.spanbert, candidate_pairs, self.batch_size)
         # print(relation_preds)
-        return [
-            (candidate_pairs[i], relation_preds[i]) for i in range(len(candidate_pairs))
-        ]
+        return list(zip(candidate_pairs, relation_preds))
@@ -0,0 +1,515 @@
+"""
+End-to-end benchmark of the ISE loop on a recorded corpus, without Google,
+OpenAI or web access. Searches come from the corpus (loaded into a temporary
+search cache), pages are served by local HTTP servers (one per site), SpanBERT
+is replaced by a deterministic stub, and GPT-3 by a stub completion endpoint
+answering from the recorded completions. spaCy is the real pipeline.
+Each extractor runs in its own process, so its peak RSS is its own. With
+-processes, the worker processes get the same SpanBERT stub (built in each
+worker by stub_models); stage timings and sentence counts cover the main
+process only.
+
+Usage: python3 SpanBERT/benchmarks/bench_ise.py [-extractors spanbert gpt3]
+           [-flags "-mode pipeline ..."] [-json out.json] [-baseline old.json]
+"""
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shlex
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prettytable import PrettyTable
+
+FIXTURE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures", "ise_corpus.json"
+)
+ENGINE_ID = "bench"
+# Metrics compared with -baseline: (key, higher is better)
+HEADLINE = [
+    ("pages_per_s", True),
+    ("sentences_per_s", True),
+    ("pairs_per_s", True),
+    ("wall_s", False),
+    ("peak_rss_mb", False),
+]
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """
+    GET  /<site>/<page>   -> the recorded HTML of the page (query strings are ignored)
+    POST .../completions  -> an OpenAI completion answering from the recorded completions
+    """
+
+    server_version = "ISEFixture/1.0"
+
+    def log_message(self, format, *args):
+        return
+
+    def reply(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].lstrip("/")
+        html = self.server.corpus["pages"].get(path)
+        if html is None:
+            self.reply(404, b"not found", "text/plain")
+        else:
+            self.reply(200, html.encode("utf-8"), "text/html; charset=utf-8")
+
+    def do_POST(self):
+        if not self.path.endswith("/completions"):
+            self.reply(404, b"not found", "text/plain")
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.server.llm_ms:
+            time.sleep(self.server.llm_ms / 1000)
+        text = answer(self.server.corpus["completions"], request["prompt"])
+        body = {
+            "id": "cmpl-bench",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.get("model") or "text-davinci-003",
+            "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+        self.reply(200, json.dumps(body).encode("utf-8"), "application/json")
+
+
+def answer(completions: Dict[str, Dict], prompt: str) -> str:
+    """
+    Returns: the recorded answer to a single or packed prompt; a sentence
+             without a recorded answer has no relation
+    """
+    def lookup(sentence):
+        for key, output in completions.items():
+            if key in sentence:
+                return output
+        return None
+
+    packed = re.findall(r"Input (\d+): (.*?)(?= Input \d+: | Output:)", prompt)
+    if packed:
+        items = []
+        for index, sentence in packed:
+            output = lookup(sentence)
+            items.append(dict({"INDEX": int(index)}, **(output or {})))
+        return json.dumps(items)
+    sentence = prompt.rsplit("Input: ", 1)[-1]
+    output = lookup(sentence)
+    return json.dumps(output) if output else "{}"
+
+
+def start_servers(corpus: Dict, llm_ms: float) -> Dict[str, str]:
+    """
+    Serve the corpus: one server per site (the first path segment), so that
+    pages of different sites have different hosts, and one for completions.
+    Returns:
+        {site: base URL}, with the completion endpoint under "llm"
+    """
+    sites = sorted({path.split("/", 1)[0] for path in corpus["pages"]}) + ["llm"]
+    bases = {}
+    for site in sites:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+        server.daemon_threads = True
+        server.corpus = corpus
+        server.llm_ms = llm_ms
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        bases[site] = f"http://127.0.0.1:{server.server_address[1]}"
+    return bases
+
+
+class StubSpanBERT:
+    """
+    Deterministic stand-in for the SpanBERT model: the confidence of a pair is
+    a hash of its tokens and entities, so runs extract the same relations.
+    """
+
+    def __init__(self, label: str, ms_per_pair: float = 0.0) -> None:
+        self.label = label
+        self.ms_per_pair = ms_per_pair
+
+    def predict(self, examples: List[Dict]) -> List:
+        if self.ms_per_pair:
+            time.sleep(self.ms_per_pair * len(examples) / 1000)
+        preds = []
+        for example in examples:
+            key = "|".join(
+                [" ".join(example["tokens"]), example["subj"][0], example["obj"][0]]
+            )
+            confidence = (zlib.crc32(key.encode("utf-8")) & 0xFFFFFFFF) / 0xFFFFFFFF
+            preds.append((self.label if confidence >= 0.5 else "no_relation", confidence))
+        return preds
+
+
+def stub_models(label: str, ms_per_pair: float) -> Dict:
+    """
+    Returns: the models of a benchmark run: the SpanBERT stub (also called in
+             -processes workers, so that they never load the real checkpoint)
+    """
+    return {"spanbert": StubSpanBERT(label, ms_per_pair)}
+
+
+def timed(owner, name: str, samples: List[float]) -> None:
+    """
+    Replace a method of an object by a wrapper appending each call's duration to samples
+    """
+    method = getattr(owner, name)
+
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+
+    setattr(owner, name, wrapper)
+
+
+def percentile(sorted_samples: List[float], q: float) -> float:
+    """
+    Returns: the nearest-rank q-th percentile of sorted samples
+    """
+    if not sorted_samples:
+        return 0.0
+    rank = math.ceil(q / 100 * len(sorted_samples)) - 1
+    rank = max(0, min(len(sorted_samples) - 1, rank))
+    return sorted_samples[rank]
+
+
+def seed_searches(corpus: Dict, bases: Dict[str, str], path: str) -> None:
+    """
+    Load the recorded searches into the search cache at path, with links to the fixture servers
+    """
+    from lib.cache import SearchCache
+
+    cache = SearchCache(path)
+    for query, links in corpus["searches"].items():
+        items = [
+            {"link": f"{bases[link.split('/', 1)[0]]}/{link}", "title": link}
+            for link in links
+        ]
+        cache.putResults(query, ENGINE_ID, items)
+    cache.close()
+
+
+def run_scenario(extractor: str, options: Dict) -> Dict:
+    """
+    Run ISE with one extractor over the corpus (in a child process)
+    Returns:
+        the scenario's metrics
+    """
+    from lib import log as ise_log
+    from lib.utils import TARGET_RELATION_PREDS
+    from main import build_parser, run_ise
+    from QueryExecutor import QueryExecutor
+
+    class BenchExecutor(QueryExecutor):
+        "Answers searches from the recorded corpus only"
+
+        def getQueryResult(self, query: str, k) -> List:
+            items = self.search_cache.getResults(query, self.google_engine_id)
+            return (items or [])[0:k]
+
+    corpus = options["corpus"]
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "bench.db")
+        seed_searches(corpus, options["bases"], db)
+        argv = [
+            f"-{extractor}",
+            "bench-key",
+            ENGINE_ID,
+            "bench-key",
+            str(corpus["relation"]),
+            str(options["t"]),
+            corpus["seed"],
+            str(options["k"]),
+            "-cache",
+            db,
+            "-openai-base",
+            f"{options['bases']['llm']}/v1",
+        ] + options["flags"]
+        args = build_parser().parse_args(argv)
+        # As main() does, so that -flags "-log quiet" is measured too.
+        ise_log.configure(args.log)
+        models = {}
+        worker_models = None
+        if extractor == "spanbert":
+            worker_models = functools.partial(
+                stub_models,
+                TARGET_RELATION_PREDS[corpus["relation"]][0],
+                options["spanbert_ms"],
+            )
+            models = worker_models()
+        executor = BenchExecutor(args, models=models, worker_models=worker_models)
+        executor.loadExtractor()
+
+        stages: Dict[str, List[float]] = {
+            name: [] for name in ("search", "fetch", "parse", "annotate", "extract")
+        }
+        timed(executor, "getQueryResult", stages["search"])
+        timed(executor, "loadPage", stages["fetch"])
+        timed(executor, "extractText", stages["parse"])
+        timed(executor.extractor, "annotate", stages["annotate"])
+        timed(executor.extractor, "annotate_batch", stages["annotate"])
+        timed(executor.extractor, "get_relations_from_doc", stages["extract"])
+        if extractor == "spanbert":
+            stages["spanbert"] = []
+            timed(executor.extractor.spanbert, "predict", stages["spanbert"])
+        else:
+            stages["llm"] = []
+            timed(executor.extractor.dispatcher, "complete", stages["llm"])
+
+        started = time.perf_counter()
+        iterations = run_ise(executor)
+        wall = time.perf_counter() - started
+        type_index = executor.extractor.type_index
+        metrics = {
+            "extractor": extractor,
+            "flags": options["flags"],
+            "wall_s": wall,
+            "startup_s": dict(executor.startup_times),
+            "iterations": iterations,
+            "relations": len(executor.extractor.relations),
+            "pages": executor.url_frontier.pages,
+            "sentences": type_index.sentences,
+            "candidate_pairs": type_index.pairs,
+            "pages_per_s": executor.url_frontier.pages / wall,
+            "sentences_per_s": type_index.sentences / wall,
+            "pairs_per_s": type_index.pairs / wall,
+            "stages": {},
+        }
+        for name, samples in stages.items():
+            samples = sorted(samples)
+            metrics["stages"][name] = {
+                "count": len(samples),
+                "total_s": sum(samples),
+                "p50_ms": 1000 * percentile(samples, 50),
+                "p90_ms": 1000 * percentile(samples, 90),
+                "p99_ms": 1000 * percentile(samples, 99),
+                "max_ms": 1000 * (samples[-1] if samples else 0.0),
+            }
+        executor.close()
+        ise_log.shutdown()
+    # ru_maxrss is in kilobytes on Linux.
+    metrics["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    metrics["children_peak_rss_mb"] = (
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    )
+    return metrics
+
+
+def scenario_process(extractor: str, options: Dict, results) -> None:
+    """
+    Child process entry point: put ("ok", metrics) or ("error", traceback) on results
+    """
+    if not options["verbose"]:
+        # At the descriptor level, so that -processes workers are silenced too.
+        sys.stdout.flush()
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    try:
+        results.put(("ok", run_scenario(extractor, options)))
+    except BaseException:
+        results.put(("error", traceback.format_exc()))
+
+
+def run_isolated(extractor: str, options: Dict) -> Dict:
+    """
+    Run a scenario in a fresh (non-daemon, so -processes works) child process
+    Returns:
+        the scenario's metrics
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=scenario_process, args=(extractor, options, results))
+    process.start()
+    status, value = results.get()
+    process.join()
+    if status != "ok":
+        raise RuntimeError(f"{extractor} run failed:\n{value}")
+    return value
+
+
+def print_report(runs: Dict[str, Dict]) -> None:
+    table = PrettyTable()
+    table.field_names = [
+        "Extractor",
+        "Wall (s)",
+        "Pages",
+        "Pages / s",
+        "Sentences / s",
+        "Pairs / s",
+        "Relations",
+        "Peak RSS (MB)",
+    ]
+    for name, run in runs.items():
+        table.add_row(
+            [
+                name,
+                f"{run['wall_s']:.2f}",
+                run["pages"],
+                f"{run['pages_per_s']:.2f}",
+                f"{run['sentences_per_s']:.1f}",
+                f"{run['pairs_per_s']:.1f}",
+                run["relations"],
+                f"{run['peak_rss_mb']:.0f}",
+            ]
+        )
+    print(table)
+    stages = PrettyTable()
+    stages.field_names = [
+        "Extractor",
+        "Stage",
+        "Calls",
+        "Total (s)",
+        "p50 (ms)",
+        "p90 (ms)",
+        "p99 (ms)",
+        "Max (ms)",
+    ]
+    for name, run in runs.items():
+        for stage, stats in run["stages"].items():
+            stages.add_row(
+                [
+                    name,
+                    stage,
+                    stats["count"],
+                    f"{stats['total_s']:.3f}",
+                    f"{stats['p50_ms']:.2f}",
+                    f"{stats['p90_ms']:.2f}",
+                    f"{stats['p99_ms']:.2f}",
+                    f"{stats['max_ms']:.2f}",
+                ]
+            )
+    print(stages)
+
+
+def print_comparison(runs: Dict[str, Dict], baseline: Dict) -> None:
+    """
+    Print the headline metrics and stage medians of each run next to a previous run's
+    """
+    table = PrettyTable()
+    table.field_names = ["Extractor", "Metric", "Baseline", "Now", "Change"]
+    for name, run in runs.items():
+        old = baseline["runs"].get(name)
+        if old is None:
+            continue
+        rows = [(key, old.get(key), run[key], higher) for key, higher in HEADLINE]
+        rows += [
+            (
+                f"{stage} p50_ms",
+                old["stages"].get(stage, {}).get("p50_ms"),
+                stats["p50_ms"],
+                False,
+            )
+            for stage, stats in run["stages"].items()
+        ]
+        for key, before, now, higher in rows:
+            if not before:
+                continue
+            change = 100 * (now - before) / before
+            better = change >= 0 if higher else change <= 0
+            table.add_row(
+                [
+                    name,
+                    key,
+                    f"{before:.2f}",
+                    f"{now:.2f}",
+                    f"{change:+.1f}%" + ("" if better else " (worse)"),
+                ]
+            )
+    print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "-extractors", nargs="+", choices=["spanbert", "gpt3"], default=["spanbert", "gpt3"]
+    )
+    parser.add_argument("-corpus", default=FIXTURE, help="recorded corpus (JSON)")
+    parser.add_argument(
+        "-flags", default="", help='extra main.py flags, e.g. "-mode pipeline -spacy-batch 4"'
+    )
+    parser.add_argument(
+        "-k", type=int, default=1000, help="tuples requested (default: the whole corpus)"
+    )
+    parser.add_argument("-t", type=float, default=0.7, help="extraction threshold")
+    parser.add_argument(
+        "-spanbert-ms",
+        dest="spanbert_ms",
+        type=float,
+        default=0.0,
+        help="simulated SpanBERT latency per pair (ms)",
+    )
+    parser.add_argument(
+        "-llm-ms",
+        dest="llm_ms",
+        type=float,
+        default=0.0,
+        help="simulated completion latency (ms)",
+    )
+    parser.add_argument("-json", default=None, help="write the results to this file")
+    parser.add_argument(
+        "-baseline", default=None, help="compare with the results of a previous -json run"
+    )
+    parser.add_argument(
+        "-verbose", action="store_true", default=False, help="show the ISE output"
+    )
+    args = parser.parse_args()
+
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+    bases = start_servers(corpus, args.llm_ms)
+    options = {
+        "corpus": corpus,
+        "bases": bases,
+        "flags": shlex.split(args.flags),
+        "k": args.k,
+        "t": args.t,
+        "spanbert_ms": args.spanbert_ms,
+        "verbose": args.verbose,
+    }
+    runs = {extractor: run_isolated(extractor, options) for extractor in args.extractors}
+    print_report(runs)
+
+    results = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "corpus": os.path.abspath(args.corpus),
+            "flags": options["flags"],
+            "spanbert_ms": args.spanbert_ms,
+            "llm_ms": args.llm_ms,
+        },
+        "runs": runs,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            print_comparison(runs, json.load(f))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark: the single-pass TextNormalizer against the previous chain of
+three re.sub calls and a str.replace.
+
+Usage: python3 SpanBERT/benchmarks/bench_normalize.py [-chars N] [-repeat N]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.htmltext import ParagraphTextParser
+from lib.normalize import TextNormalizer
+
+
+def chain(text: str) -> str:
+    "The normalization QueryExecutor.processText used to do"
+    text = re.sub("\t+", " ", text)
+    text = re.sub("\n+", " ", text)
+    text = re.sub(" +", " ", text)
+    return text.replace("\u200b", "")
+
+
+def sample_text(chars: int, seed: int = 0) -> str:
+    """
+    Returns: webpage-like text of about chars characters: words separated mostly
+             by single spaces, with some newline/tab/NBSP runs and zero-width spaces
+    """
+    rng = random.Random(seed)
+    separators = [" "] * 100 + ["  ", "\n", "\n\n  ", "\t", "  ", "\u200b", " \u200b "]
+    words = ["relation", "extraction", "Google", "founded", "in", "1998", "by", "Larry"]
+    parts = []
+    length = 0
+    while length < chars:
+        part = rng.choice(words) + rng.choice(separators)
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def streamed(normalizer: Optional[TextNormalizer], html: str) -> str:
+    "Normalize while parsing, as fetchPage does"
+    parser = ParagraphTextParser(normalizer)
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-chars", type=int, default=10000, help="text size")
+    parser.add_argument("-repeat", type=int, default=2000, help="runs per method")
+    args = parser.parse_args()
+
+    text = sample_text(args.chars)
+    html = "".join(f"<p>{para}</p>" for para in text.split("\n\n"))
+    normalizer = TextNormalizer()
+
+    methods = [
+        ("re.sub chain", lambda: chain(text)),
+        ("TextNormalizer", lambda: normalizer.normalize(text)),
+        ("parse only", lambda: streamed(None, html)),
+        ("parse + normalize", lambda: streamed(normalizer, html)),
+    ]
+    print(f"{args.chars} characters, {args.repeat} runs each")
+    for name, fn in methods:
+        seconds = min(timeit.repeat(fn, number=args.repeat, repeat=3)) / args.repeat
+        print(f"{name:<20} {seconds * 1e6:10.1f} us/text")
+
+
+if __name__ == "__main__":
+    main()
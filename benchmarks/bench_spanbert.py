@@ -0,0 +1,129 @@
+"""
+Accuracy/latency comparison of the SpanBERT inference backends on a fixed
+sentence set. The fp32 backend is the reference: every other backend is
+compared with it on the predicted relation, the confidence, and the
+keep/drop decision check_relation_prediction takes at threshold -t.
+
+Usage: python3 SpanBERT/benchmarks/bench_spanbert.py [-backends fp32 int8] [-repeat N] [-t T]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prettytable import PrettyTable
+
+from lib.backends import SPANBERT_BACKENDS, load_spanbert, predict_batched
+from lib.entities import RelationTypeIndex
+from lib.nlp import load_pipeline
+from lib.utils import RELATIONS
+
+# Fixed inputs, covering the entity types of all four relations.
+SENTENCES = [
+    "Jeff Bezos graduated from Princeton University in 1986 with a degree in electrical engineering.",
+    "Bill Gates attended Harvard University before dropping out to found Microsoft with Paul Allen.",
+    "Mark Zuckerberg launched Facebook from his dorm room at Harvard in 2004.",
+    "Sundar Pichai studied at Stanford University and the Wharton School before joining Google.",
+    "Alec Radford has recently announced he will switch employers to OpenAI.",
+    "Satya Nadella is the chief executive officer of Microsoft.",
+    "Jensen Huang is the CEO of Nvidia, which he co-founded in 1993.",
+    "Tim Cook succeeded Steve Jobs as the head of Apple in 2011.",
+    "Sheryl Sandberg worked at Google before becoming the chief operating officer of Facebook.",
+    "Mariah Carey has a home in Manhattan, New York City.",
+    "Taylor Swift bought a house in Rhode Island and also lives in Nashville, Tennessee.",
+    "Elon Musk moved from California to Texas in 2020.",
+    "Barack Obama, who grew up in Honolulu, later lived in Chicago with Michelle Obama.",
+    "Larry Page and Sergey Brin met at Stanford University and founded Google in Menlo Park.",
+    "Susan Wojcicki, the former chief executive of YouTube, studied history at Harvard University.",
+    "Ginni Rometty led IBM for eight years after graduating from Northwestern University.",
+]
+
+
+def candidate_pairs(nlp):
+    """
+    Returns: {relation: the candidate pairs of SENTENCES for that relation}
+    """
+    docs = list(nlp.pipe(SENTENCES))
+    pairs = {}
+    for r in RELATIONS:
+        type_index = RelationTypeIndex(r)
+        pairs[r] = [
+            pair
+            for doc in docs
+            for sentence in doc.sents
+            if type_index.keep(sentence)
+            for pair in type_index.candidatePairs(sentence)
+        ]
+    return pairs
+
+
+def score(spanbert, pairs, batch_size):
+    """
+    Score all pairs the way spanBertExtractor does
+    Returns: ({relation: [(label, confidence), ...]}, seconds)
+    """
+    preds = {}
+    started = time.perf_counter()
+    for r, candidates in pairs.items():
+        preds[r] = predict_batched(spanbert, candidates, batch_size)
+    return preds, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "-backends", nargs="+", choices=SPANBERT_BACKENDS, default=SPANBERT_BACKENDS
+    )
+    parser.add_argument("-repeat", type=int, default=3, help="timed runs per backend")
+    parser.add_argument("-batch", type=int, default=32, help="pairs per forward pass")
+    parser.add_argument("-t", type=float, default=0.7, help="extraction threshold")
+    args = parser.parse_args()
+    backends = ["fp32"] + [b for b in args.backends if b != "fp32"]
+
+    pairs = candidate_pairs(load_pipeline())
+    num_pairs = sum(len(candidates) for candidates in pairs.values())
+    print(f"{len(SENTENCES)} sentences, {num_pairs} candidate pairs over {len(pairs)} relations")
+
+    table = PrettyTable()
+    table.field_names = [
+        "Backend",
+        "Load (s)",
+        "ms / pair",
+        "Pairs / s",
+        "Same relation",
+        "Mean |d conf|",
+        "Max |d conf|",
+        f"Same decision (t={args.t})",
+    ]
+    reference = None
+    for backend in backends:
+        started = time.perf_counter()
+        spanbert = load_spanbert(backend)
+        load = time.perf_counter() - started
+        preds, _ = score(spanbert, pairs, args.batch)  # warm-up
+        seconds = min(score(spanbert, pairs, args.batch)[1] for _ in range(args.repeat))
+        flat = [pred for r in pairs for pred in preds[r]]
+        if reference is None:
+            reference = flat
+        deltas = [abs(float(p[1]) - float(q[1])) for p, q in zip(flat, reference)]
+        n = max(len(flat), 1)
+        table.add_row(
+            [
+                backend,
+                f"{load:.1f}",
+                f"{1000 * seconds / max(num_pairs, 1):.2f}",
+                f"{num_pairs / seconds:.1f}" if seconds else "-",
+                f"{100 * sum(p[0] == q[0] for p, q in zip(flat, reference)) / n:.1f}%",
+                f"{sum(deltas) / n:.4f}",
+                f"{max(deltas, default=0.0):.4f}",
+                f"{100 * sum((p[1] >= args.t) == (q[1] >= args.t) for p, q in zip(flat, reference)) / n:.1f}%",
+            ]
+        )
+        del spanbert
+    print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+SpanBERT inference backends
+"""
+from typing import Dict, List, Tuple
+
+PRETRAINED_SPANBERT = "./SpanBERT/pretrained_spanbert"
+
+# fp32: the stock PyTorch model.
+# int8: the same model with its Linear layers dynamically quantized to int8 (CPU only).
+SPANBERT_BACKENDS: List[str] = ["fp32", "int8"]
+
+
+def load_spanbert(backend: str = "fp32", pretrained_dir: str = PRETRAINED_SPANBERT):
+    """
+    Load the fine-tuned SpanBERT relation classifier for one backend
+    Parameters:
+        backend: one of SPANBERT_BACKENDS
+        pretrained_dir: the directory of the fine-tuned model
+    Returns:
+        spanbert: a SpanBERT object; predict() returns (relation, confidence)
+                  pairs whatever the backend
+    """
+    if backend not in SPANBERT_BACKENDS:
+        raise ValueError(f"unknown SpanBERT backend: {backend}")
+    from spanbert import SpanBERT
+
+    spanbert = SpanBERT(pretrained_dir)
+    if backend == "int8":
+        quantize_dynamic(spanbert)
+    return spanbert
+
+
+def quantize_dynamic(spanbert) -> None:
+    """
+    Replace the model of a loaded SpanBERT object by a dynamically quantized
+    copy: Linear weights are stored as int8 and activations are quantized on
+    the fly. The encoder's matrix multiplications, which dominate CPU time,
+    then run in int8. Quantized kernels are CPU-only, so the model is moved
+    to the CPU.
+    Parameters:
+        spanbert: a SpanBERT object, modified in place
+    """
+    import torch
+
+    spanbert.device = torch.device("cpu")
+    spanbert.model.to(spanbert.device)
+    spanbert.model = torch.quantization.quantize_dynamic(
+        spanbert.model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    spanbert.model.eval()
+
+
+def predict_batched(
+    spanbert, candidate_pairs: List[Dict], batch_size: int = 32
+) -> List[Tuple]:
+    """
+    Score candidate pairs in mini-batches of similar token length, which keeps
+    padding low, and put the predictions back in the order of the pairs.
+    Parameters:
+        spanbert: a SpanBERT object of any backend
+        candidate_pairs: the pairs to score
+        batch_size: the number of pairs per forward pass
+    Returns:
+        the (relation, confidence) prediction of each pair
+    """
+    order = sorted(
+        range(len(candidate_pairs)), key=lambda i: len(candidate_pairs[i]["tokens"])
+    )
+    relation_preds = [None] * len(candidate_pairs)
+    for start in range(0, len(order), batch_size):
+        batch = order[start : start + batch_size]
+        preds = spanbert.predict([candidate_pairs[i] for i in batch])
+        for i, pred in zip(batch, preds):
+            relation_preds[i] = pred
+    return relation_preds
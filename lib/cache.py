@@ -0,0 +1,323 @@
+"""
+Persistent SQLite caches shared across runs
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Puts after which a cache with a TTL or size limit evicts, so long runs stay bounded.
+EVICT_EVERY = 1000
+
+
+class SqliteCache:
+    "A key/value table in a SQLite file with TTL and size-based eviction"
+
+    TABLE = "entries"
+
+    def __init__(
+        self, path: str, ttl: Optional[float] = None, max_bytes: Optional[int] = None
+    ) -> None:
+        """
+        Initialize a SqliteCache object
+        Parameters:
+            path: the SQLite file; several caches can share one file
+            ttl: seconds after which an entry expires (None: never)
+            max_bytes: the total size of stored values kept after eviction, across
+                       every cache table of the file (None: unbounded)
+        Instance Variables:
+            hits: the number of lookups answered from the cache
+            misses: the number of lookups that were not
+            puts: the number of values stored since the last eviction
+        """
+        for name, limit in (("ttl", ttl), ("max_bytes", max_bytes)):
+            if limit is not None and limit <= 0:
+                raise ValueError(f"{name} has to be greater than 0, got {limit}")
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.TABLE} ("
+                "key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL, size INTEGER)"
+            )
+
+    @staticmethod
+    def digest(*parts: str) -> str:
+        """
+        Hash the parts of a key into a fixed-size cache key
+        """
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Look up a value, counting the hit or miss
+        Parameters:
+            key: the cache key
+        Returns:
+            bytes if present and not expired; else None
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT value, created FROM {self.TABLE} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            with self.conn:
+                self.conn.execute(
+                    f"UPDATE {self.TABLE} SET accessed = ? WHERE key = ?", (now, key)
+                )
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: bytes) -> None:
+        """
+        Store a value, replacing any previous value for the key
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.TABLE} VALUES (?, ?, ?, ?, ?)",
+                (key, value, now, now, len(value)),
+            )
+        self.stored(1)
+
+    def putMany(self, items: Iterable[Tuple[str, bytes]]) -> None:
+        """
+        Store several values in one transaction
+        Parameters:
+            items: (key, value) pairs
+        """
+        now = time.time()
+        rows = [(key, value, now, now, len(value)) for key, value in items]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {self.TABLE} VALUES (?, ?, ?, ?, ?)", rows
+            )
+        self.stored(len(rows))
+
+    def stored(self, count: int) -> None:
+        """
+        Count stored values and evict every EVICT_EVERY of them
+        """
+        if self.ttl is None and self.max_bytes is None:
+            return
+        with self.lock:
+            self.puts += count
+            due = self.puts >= EVICT_EVERY
+        if due:
+            self.evict()
+
+    def tables(self) -> List[str]:
+        """
+        Returns: the cache tables of the file (this one and those of the caches sharing it)
+        """
+        names = [
+            row[0]
+            for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        ]
+        return [
+            name
+            for name in names
+            if {"key", "accessed", "size"}
+            <= {row[1] for row in self.conn.execute(f'PRAGMA table_info("{name}")')}
+        ]
+
+    def evict(self) -> int:
+        """
+        Drop this table's expired entries, then the least recently used entries of
+        all cache tables in the file until their stored values fit in max_bytes
+        together: caches sharing a file share one budget.
+        Returns:
+            int - the number of entries removed
+        """
+        removed = 0
+        with self.lock, self.conn:
+            self.puts = 0
+            if self.ttl is not None:
+                removed += self.conn.execute(
+                    f"DELETE FROM {self.TABLE} WHERE created < ?",
+                    (time.time() - self.ttl,),
+                ).rowcount
+            if self.max_bytes is not None:
+                rows = self.conn.execute(
+                    " UNION ALL ".join(
+                        f"SELECT '{table}', key, size, accessed FROM \"{table}\""
+                        for table in self.tables()
+                    )
+                    + " ORDER BY accessed"
+                ).fetchall()
+                total = sum(row[2] for row in rows)
+                doomed: Dict[str, List[Tuple[str]]] = {}
+                for table, key, size, _ in rows:
+                    if total <= self.max_bytes:
+                        break
+                    doomed.setdefault(table, []).append((key,))
+                    total -= size
+                    removed += 1
+                for table, keys in doomed.items():
+                    self.conn.executemany(f'DELETE FROM "{table}" WHERE key = ?', keys)
+        return removed
+
+    def close(self) -> None:
+        """
+        Evict and close the connection
+        """
+        self.evict()
+        with self.lock:
+            self.conn.close()
+
+    def report(self) -> str:
+        """
+        Returns: a one-line hit/miss summary
+        """
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups else 0.0
+        return f"{self.TABLE:<12} hits: {self.hits:<6} misses: {self.misses:<6} hit rate: {rate:.1f}%"
+
+
+class PageCache(SqliteCache):
+    "Cleaned webpage text keyed by URL, stored zlib-compressed"
+
+    TABLE = "pages"
+
+    def getText(self, url: str) -> Optional[str]:
+        """
+        Returns: the cached text of the URL ("" if the page had no usable text), or None
+        """
+        value = self.get(self.digest(url))
+        return None if value is None else zlib.decompress(value).decode("utf-8")
+
+    def putText(self, url: str, text: str) -> None:
+        """
+        Store the cleaned text of the URL
+        """
+        self.put(self.digest(url), zlib.compress(text.encode("utf-8")))
+
+
+class SearchCache(SqliteCache):
+    "Custom Search API result items keyed by (query, engine id)"
+
+    TABLE = "searches"
+
+    def getResults(self, query: str, engine_id: str) -> Optional[List[Dict]]:
+        """
+        Returns: the cached result items of the query, or None
+        """
+        value = self.get(self.digest(query, engine_id))
+        return None if value is None else json.loads(value)
+
+    def putResults(self, query: str, engine_id: str, items: List[Dict]) -> None:
+        """
+        Store the result items of the query
+        """
+        self.put(self.digest(query, engine_id), json.dumps(items).encode("utf-8"))
+
+
+class CompletionCache(SqliteCache):
+    """
+    LLM completions keyed by (model, prompt, sampling parameters).
+    Recently used completions are also kept in an in-memory LRU.
+    """
+
+    TABLE = "completions"
+
+    def __init__(
+        self,
+        path: str,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        lru_size: int = 1024,
+    ) -> None:
+        """
+        Initialize a CompletionCache object
+        Parameters:
+            lru_size: the number of completions kept in memory
+        Instance Variables:
+            lru: the in-memory completions {key: (text, latency)}
+            saved_latency: the total API latency (seconds) avoided by cache hits
+        """
+        super().__init__(path, ttl, max_bytes)
+        self.lru_size = lru_size
+        self.lru: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.saved_latency = 0.0
+
+    def key(self, model: str, prompt: str, params: Dict) -> str:
+        """
+        Returns: the cache key of a completion request
+        """
+        return self.digest(model, prompt, json.dumps(params, sort_keys=True))
+
+    def getCompletion(self, key: str) -> Optional[str]:
+        """
+        Returns: the cached completion text, or None
+        """
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                text, latency = self.lru[key]
+                self.hits += 1
+                self.saved_latency += latency
+                return text
+        value = self.get(key)
+        if value is None:
+            return None
+        entry = json.loads(value)
+        with self.lock:
+            self.remember(key, entry["text"], entry["latency"])
+            self.saved_latency += entry["latency"]
+        return entry["text"]
+
+    def putCompletion(self, key: str, text: str, latency: float) -> None:
+        """
+        Store a completion and the API latency it took to produce
+        """
+        with self.lock:
+            self.remember(key, text, latency)
+        self.put(key, json.dumps({"text": text, "latency": latency}).encode("utf-8"))
+
+    def remember(self, key: str, text: str, latency: float) -> None:
+        # Callers hold self.lock.
+        self.lru[key] = (text, latency)
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def report(self) -> str:
+        return (
+            super().report()
+            + f" API calls saved: {self.hits} latency saved: {self.saved_latency:.1f}s"
+        )
+
+
+class SentenceStore(SqliteCache):
+    "Extraction results of sentences keyed by (extractor namespace, sentence fingerprint)"
+
+    TABLE = "sentences"
+
+    def getResults(self, namespace: str, fingerprint: str) -> Optional[List]:
+        """
+        Returns: the stored results of the sentence, or None
+        """
+        value = self.get(self.digest(namespace, fingerprint))
+        return None if value is None else json.loads(value)
+
+    def putResults(self, namespace: str, results: Dict[str, List]) -> None:
+        """
+        Store the results of several sentences {fingerprint: results}
+        """
+        self.putMany(
+            (self.digest(namespace, fingerprint), json.dumps(value).encode("utf-8"))
+            for fingerprint, value in results.items()
+        )
@@ -0,0 +1,39 @@
+"""
+Checkpoints of an ISE run's state, so that an interrupted run resumes where
+its last completed iteration left off: relations, the URLs seen (not fetched
+again), the queries used, the next iteration's queries and the URL frontier.
+"""
+import json
+import os
+from typing import Dict
+
+CHECKPOINT_VERSION = 1
+
+
+def save(path: str, state: Dict) -> None:
+    """
+    Write a checkpoint. The previous checkpoint is replaced only once the new
+    one is completely written, so a crash while saving keeps the previous one.
+    Parameters:
+        path: the checkpoint file
+        state: the JSON-serializable state of the run
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": CHECKPOINT_VERSION, **state}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load(path: str) -> Dict:
+    """
+    Read a checkpoint written by save
+    Returns:
+        the state of the run
+    """
+    with open(path) as f:
+        state = json.load(f)
+    if state.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"{path}: unsupported checkpoint version {state.get('version')}")
+    return state
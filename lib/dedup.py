@@ -0,0 +1,284 @@
+"""
+Deduplication of repeated content across the pages of an ISE run
+"""
+import hashlib
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from lib.cache import SentenceStore
+
+
+class SentenceIndex:
+    """
+    Fingerprints of the sentences an extractor has already processed, with
+    their extraction results. Syndicated articles and boilerplate repeat the
+    same sentences across URLs; a repeated sentence reuses its results instead
+    of being annotated and scored again.
+    """
+
+    def __init__(self, namespace: str, store: Optional[SentenceStore] = None) -> None:
+        """
+        Initialize a SentenceIndex object
+        Parameters:
+            namespace: what the results depend on, e.g. "spanbert:2"; results
+                       are only shared between indexes of the same namespace
+            store: a SentenceStore persisting results across runs (None: this run only)
+        Instance Variables:
+            results: the results of every sentence processed {fingerprint: results}
+            pending: results not yet written to the store
+            repeats: the number of sentences answered from the index
+        """
+        self.namespace = namespace
+        self.store = store
+        self.results: Dict[str, List] = {}
+        self.pending: Dict[str, List] = {}
+        self.repeats = 0
+
+    @staticmethod
+    def fingerprint(text: str) -> str:
+        """
+        Returns: a hash of the sentence that ignores case and whitespace differences
+        """
+        normalized = " ".join(text.lower().split())
+        return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+    def lookup(self, fingerprint: str) -> Optional[List]:
+        """
+        Parameters:
+            fingerprint: the sentence's fingerprint
+        Returns:
+            the results of the sentence if it was processed before (in this run
+            or, with a store, a previous one); else None
+        """
+        results = self.results.get(fingerprint)
+        if results is None and self.store is not None:
+            results = self.store.getResults(self.namespace, fingerprint)
+            if results is not None:
+                self.results[fingerprint] = results
+        if results is not None:
+            self.repeats += 1
+        return results
+
+    def add(self, fingerprint: str, results: List) -> None:
+        """
+        Record the results of a newly processed sentence
+        Parameters:
+            fingerprint: the sentence's fingerprint
+            results: JSON-serializable extraction results (empty if none)
+        """
+        self.results[fingerprint] = results
+        if self.store is not None:
+            self.pending[fingerprint] = results
+
+    def flush(self) -> None:
+        """
+        Write the pending results to the store, in one transaction
+        """
+        if self.pending:
+            self.store.putResults(self.namespace, self.pending)
+            self.pending = {}
+
+    def report(self) -> str:
+        """
+        Returns: a one-line summary of the sentences reused
+        """
+        return f"repeated sentences reused: {self.repeats:<6} unique sentences: {len(self.results)}"
+
+
+# Click identifiers that only track where a visitor came from (utm_* too).
+# Generic names such as "ref" or "amp" are kept: on many sites they select content.
+TRACKING_PARAMS = {
+    "fbclid",
+    "gclid",
+    "gbraid",
+    "wbraid",
+    "dclid",
+    "msclkid",
+    "yclid",
+    "twclid",
+    "ttclid",
+    "igshid",
+    "li_fat_id",
+    "mc_cid",
+    "mc_eid",
+    "_ga",
+}
+# Host prefixes of mobile, AMP and "www" mirrors of the same site.
+MIRROR_HOST_PREFIXES = ("www.", "m.", "mobile.", "amp.")
+
+
+def canonical_url(url: str) -> str:
+    """
+    Reduce a URL to a key shared by its trivial variants: the scheme, "www.",
+    mobile and AMP hosts or paths, default ports, tracking parameters, the
+    order of query parameters, trailing slashes and the fragment are ignored.
+    Parameters:
+        url: the URL of a search result
+    Returns:
+        str - the canonical key of the URL (not a fetchable URL)
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    path = parts.path
+    # Google AMP cache: https://www-example-com.cdn.ampproject.org/c/s/www.example.com/page
+    if host.endswith(".cdn.ampproject.org"):
+        rest = path.split("/", 3)
+        if len(rest) == 4 and rest[1] == "c":
+            origin = rest[3] if rest[2] == "s" else f"{rest[2]}/{rest[3]}"
+            host, _, path = origin.partition("/")
+            host = host.lower()
+            path = "/" + path
+    for prefix in MIRROR_HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix) :]
+            break
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    # AMP variants of a page (/page/amp, /page.amp), but not a page whose whole path is /amp.
+    if path.endswith("/amp") or path.endswith("/amp/"):
+        stripped = path[: path.rindex("/amp")]
+        path = stripped if stripped.strip("/") else path
+    elif path.endswith(".amp") and path[: -len(".amp")].strip("/"):
+        path = path[: -len(".amp")]
+    path = path.rstrip("/") or "/"
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith("utm_")
+    )
+    return f"{host}{path}?{urlencode(query)}" if query else f"{host}{path}"
+
+
+class NearDuplicateIndex:
+    """
+    MinHash signatures of the pages processed in a run, banded for
+    locality-sensitive hashing, to find pages that are near duplicates of an
+    earlier one (mirrors, syndicated copies) before they reach spaCy.
+    Signatures use one-permutation hashing: each word shingle is hashed once
+    and only lowers the minimum of the slot its hash falls in.
+    """
+
+    def __init__(
+        self, threshold: float, num_perm: int = 128, shingle_size: int = 5
+    ) -> None:
+        """
+        Initialize a NearDuplicateIndex object
+        Parameters:
+            threshold: the estimated Jaccard similarity of word shingles above
+                       which a page counts as a duplicate
+            num_perm: the number of MinHash slots per signature
+            shingle_size: the number of words per shingle
+        Instance Variables:
+            bands, rows: the LSH banding of a signature (bands * rows <= num_perm)
+            buckets: per band, the pages sharing that band's values {band: [page, ...]}
+            signatures: the signature of every page indexed
+            urls: the URL of every page indexed
+            skipped: the number of pages found to be near duplicates
+        """
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = self.banding(threshold, num_perm)
+        self.buckets: List[Dict[Tuple[int, ...], List[int]]] = [
+            {} for _ in range(self.bands)
+        ]
+        self.signatures: List[List[int]] = []
+        self.urls: List[str] = []
+        self.skipped = 0
+
+    @staticmethod
+    def banding(threshold: float, num_perm: int) -> Tuple[int, int]:
+        """
+        Pick the banding whose S-curve midpoint, (1 / bands) ** (1 / rows), is
+        the highest one at or below 90% of the threshold: pages at the threshold
+        then almost always share a band, and the extra candidates are removed
+        by comparing whole signatures.
+        Returns:
+            (bands, rows)
+        """
+        best = (num_perm, 1)
+        best_midpoint = 0.0
+        for rows in range(1, num_perm + 1):
+            bands = num_perm // rows
+            midpoint = (1 / bands) ** (1 / rows)
+            if best_midpoint < midpoint <= 0.9 * threshold:
+                best, best_midpoint = (bands, rows), midpoint
+        return best
+
+    def signature(self, text: str) -> Optional[List[int]]:
+        """
+        Returns: the MinHash signature of the text's word shingles, or None if the text has no words
+        """
+        words = text.lower().split()
+        if not words:
+            return None
+        size = min(self.shingle_size, len(words))
+        shingles = {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+        empty = 1 << 64
+        mins = [empty] * self.num_perm
+        for shingle in shingles:
+            value, slot = divmod(hash(shingle) & 0xFFFFFFFFFFFFFFFF, self.num_perm)
+            if value < mins[slot]:
+                mins[slot] = value
+        # Densify: an empty slot borrows the value of the next filled one
+        # (wrapping around), so short pages still get comparable signatures.
+        if empty in mins:
+            filled = list(mins)
+            carry = None
+            for i in reversed(range(2 * self.num_perm)):
+                slot = i % self.num_perm
+                if filled[slot] != empty:
+                    carry = filled[slot]
+                elif i < self.num_perm:
+                    mins[slot] = carry
+        return mins
+
+    def similarity(self, a: List[int], b: List[int]) -> float:
+        """
+        Returns: the estimated Jaccard similarity of two signatures
+        """
+        return sum(x == y for x, y in zip(a, b)) / self.num_perm
+
+    def check(self, url: str, text: str) -> Optional[Tuple[str, float]]:
+        """
+        Compare a page with the pages indexed so far; if it is not a near
+        duplicate of one of them, index it.
+        Parameters:
+            url: the page's URL
+            text: the page's cleaned text
+        Returns:
+            (URL, similarity) of the page it duplicates, or None
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return None
+        keys = [
+            tuple(signature[band * self.rows : (band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+        candidates = set()
+        for band, key in enumerate(keys):
+            candidates.update(self.buckets[band].get(key, ()))
+        best = None
+        for page in candidates:
+            similarity = self.similarity(signature, self.signatures[page])
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (self.urls[page], similarity)
+        if best is not None:
+            self.skipped += 1
+            return best
+        page = len(self.signatures)
+        self.signatures.append(signature)
+        self.urls.append(url)
+        for band, key in enumerate(keys):
+            self.buckets[band].setdefault(key, []).append(page)
+        return None
+
+    def report(self) -> str:
+        """
+        Returns: a one-line summary of the pages skipped
+        """
+        return (
+            f"near-duplicate pages skipped: {self.skipped:<6} pages indexed: {len(self.signatures)}"
+            f" (threshold {self.threshold}, {self.bands} bands x {self.rows} rows)"
+        )
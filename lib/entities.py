@@ -0,0 +1,101 @@
+"""
+Per-relation entity type index: picks out the sentences and entity pairs that
+can hold the target relation before any pair is scored.
+"""
+from typing import Dict, List
+
+from spacy_help_functions import create_entity_pairs
+
+from lib.utils import ENTITIES_OF_INTEREST, SPACY_LABELS, SUBJ_OBJ_REQUIRED_ENTITIES
+
+
+class RelationTypeIndex:
+    "The subject/object entity types of one relation, as SpanBERT types and spaCy labels"
+
+    def __init__(self, r: int) -> None:
+        """
+        Initialize a RelationTypeIndex object
+        Parameters:
+            r: the relation to extract
+        Instance Variables:
+            subj_types, obj_types: the SpanBERT entity types of the subject / object
+            subj_labels, obj_labels: the spaCy labels of the subject / object
+            sentences: the number of sentences looked at
+            skipped: the number of sentences skipped on their entity labels alone
+            candidate_sentences: the number of sentences with at least one candidate pair
+            pairs: the number of candidate pairs built
+        """
+        required = SUBJ_OBJ_REQUIRED_ENTITIES[r]
+        self.entities_of_interest = ENTITIES_OF_INTEREST[r]
+        self.subj_types = frozenset(required["SUBJ"])
+        self.obj_types = frozenset(required["OBJ"])
+        self.subj_labels = frozenset(SPACY_LABELS[t] for t in required["SUBJ"])
+        self.obj_labels = frozenset(SPACY_LABELS[t] for t in required["OBJ"])
+        self.sentences = 0
+        self.skipped = 0
+        self.candidate_sentences = 0
+        self.pairs = 0
+
+    def admits(self, sentence) -> bool:
+        """
+        Check whether the entity labels of a sentence can make up a subject and a
+        distinct object of the relation
+        Parameters:
+            sentence: a spaCy sentence
+        Returns:
+            bool - False if no (subject, object) pair of the right types can exist
+        """
+        subj = obj = either = 0
+        for ent in sentence.ents:
+            is_subj = ent.label_ in self.subj_labels
+            is_obj = ent.label_ in self.obj_labels
+            subj += is_subj
+            obj += is_obj
+            either += is_subj or is_obj
+        # Subject and object must be two different entities.
+        return subj > 0 and obj > 0 and either > 1
+
+    def keep(self, sentence) -> bool:
+        """
+        Count a sentence and check it with admits(); sentences ruled out are
+        skipped without building any entity pair.
+        Parameters:
+            sentence: a spaCy sentence
+        Returns:
+            bool - whether the sentence can hold the relation
+        """
+        self.sentences += 1
+        if not self.admits(sentence):
+            self.skipped += 1
+            return False
+        return True
+
+    def candidatePairs(self, sentence) -> List[Dict]:
+        """
+        Build the candidate pairs of a sentence kept by keep(), each in the
+        orientation the relation needs.
+        Parameters:
+            sentence: a spaCy sentence
+        Returns:
+            candidate_pairs: a list of {"tokens": tokens, "subj": entity, "obj": entity}
+        """
+        candidate_pairs = []
+        for tokens, e1, e2 in create_entity_pairs(sentence, self.entities_of_interest):
+            if e1[1] in self.subj_types and e2[1] in self.obj_types:
+                candidate_pairs.append({"tokens": tokens, "subj": e1, "obj": e2})
+            if e2[1] in self.subj_types and e1[1] in self.obj_types:
+                candidate_pairs.append({"tokens": tokens, "subj": e2, "obj": e1})
+        if candidate_pairs:
+            self.candidate_sentences += 1
+            self.pairs += len(candidate_pairs)
+        return candidate_pairs
+
+    def report(self) -> str:
+        """
+        Returns: a one-line summary of the sentences skipped and kept
+        """
+        rate = 100 * self.skipped / self.sentences if self.sentences else 0.0
+        return (
+            f"sentences: {self.sentences:<6} skipped by entity types: {self.skipped:<6}"
+            f" ({rate:.1f}%) with candidate pairs: {self.candidate_sentences} (pairs: {self.pairs})"
+        )
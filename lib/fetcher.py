@@ -0,0 +1,85 @@
+"""
+Concurrent page fetching for the QueryExecutor
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PageFetcher:
+    "Fetches a batch of URLs in parallel over a pooled, keep-alive requests.Session"
+
+    def __init__(self, concurrency: int = 10, per_host: int = 2) -> None:
+        """
+        Initialize a PageFetcher object
+        Parameters:
+            concurrency: the maximum number of requests in flight at once
+            per_host: the maximum number of requests in flight to a single host
+        Instance Variables:
+            session: the shared requests.Session; connections are kept alive per host
+            pool: the thread pool that runs the fetches
+            host_slots: a dictionary of per-host semaphores {host: Semaphore}
+        """
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="fetch"
+        )
+        self.host_slots: Dict[str, threading.Semaphore] = {}
+        self.host_lock = threading.Lock()
+
+    def hostSlot(self, url: str) -> threading.Semaphore:
+        """
+        Get the semaphore limiting concurrent requests to the host of a URL
+        Parameters:
+            url (str) - the URL about to be fetched
+        Returns:
+            threading.Semaphore - the slot for the URL's host
+        """
+        host = urlsplit(url).netloc.lower()
+        with self.host_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.Semaphore(self.per_host)
+            return self.host_slots[host]
+
+    def fetch(self, url: str, handler: Callable[[requests.Session, str], Any]) -> Any:
+        """
+        Run handler(session, url) while holding a slot for the URL's host
+        """
+        with self.hostSlot(url):
+            return handler(self.session, url)
+
+    def fetchAll(
+        self, urls: Iterable[str], handler: Callable[[requests.Session, str], Any]
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        Fetch all URLs concurrently and yield results as they arrive.
+        Fetches that have not started yet are cancelled if the caller stops iterating.
+        Parameters:
+            urls - the URLs to fetch
+            handler - called as handler(session, url); its return value is yielded
+        Returns:
+            Iterator of (url, handler result), in completion order
+        """
+        futures = {self.pool.submit(self.fetch, url, handler): url for url in urls}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self) -> None:
+        """
+        Shut down the thread pool and close pooled connections
+        """
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
@@ -0,0 +1,192 @@
+"""
+Priority frontier of the URLs found by the searches of an ISE run
+"""
+import heapq
+import threading
+from typing import Dict, List
+
+from lib.dedup import canonical_url
+
+
+class HostStats:
+    "The pages of one host processed in a run, and the relations they added"
+
+    def __init__(self) -> None:
+        self.pages = 0
+        self.relations = 0
+
+
+class URLFrontier:
+    """
+    The URLs returned by searches but not processed yet. Each URL is scored by
+    its search rank, the confidence of the query that returned it, and the
+    yield of its host so far in the run; the highest scoring URLs are
+    processed first, so hosts that gave no relations sink in the queue.
+    """
+
+    def __init__(self, prior_pages: float = 2.0) -> None:
+        """
+        Initialize a URLFrontier object
+        Parameters:
+            prior_pages: how many pages of the run's average yield a host is
+                         assumed to have before its own pages are counted
+        Instance Variables:
+            pending: the URLs waiting, by canonical key {key: [url, base score]}
+            taken: the URLs popped but not recorded as processed yet {url: [key, base score]}
+            hosts: the yield of every host processed {host: HostStats}
+            pages, relations: the totals over all hosts
+        """
+        self.prior_pages = prior_pages
+        self.pending: Dict[str, List] = {}
+        self.taken: Dict[str, List] = {}
+        self.hosts: Dict[str, HostStats] = {}
+        self.pages = 0
+        self.relations = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.pending
+
+    @staticmethod
+    def host(url: str) -> str:
+        """
+        Returns: the host of a URL, with its "www."/mobile/AMP mirrors merged
+        """
+        return canonical_url(url).split("/", 1)[0]
+
+    def push(self, key: str, url: str, rank: int, confidence: float) -> None:
+        """
+        Add a search result. A URL returned by several queries adds up the
+        score of each.
+        Parameters:
+            key: the canonical URL
+            url: the URL as returned by the search
+            rank: the rank of the URL in the query's results, from 0
+            confidence: the confidence of the tuple the query was built from
+        """
+        score = confidence / (rank + 1)
+        if key in self.pending:
+            self.pending[key][1] += score
+        else:
+            self.pending[key] = [url, score]
+
+    def hostFactor(self, host: str) -> float:
+        """
+        Returns: the host's smoothed relations per page relative to the run's
+                 average (1 for a host without pages, or before any relation)
+        """
+        if not self.relations:
+            return 1.0
+        mean = self.relations / self.pages
+        stats = self.hosts.get(host)
+        if stats is None:
+            return 1.0
+        smoothed = (stats.relations + self.prior_pages * mean) / (
+            stats.pages + self.prior_pages
+        )
+        return smoothed / mean
+
+    def score(self, url: str, base: float) -> float:
+        """
+        Returns: the priority of a pending URL
+        """
+        return base * self.hostFactor(self.host(url))
+
+    def pop(self, n: int) -> List[str]:
+        """
+        Take the n highest scoring URLs, scored with the host yields as they are now
+        Returns:
+            the URLs, highest score first
+        """
+        with self.lock:
+            heap = [
+                (-self.score(url, base), order, key)
+                for order, (key, (url, base)) in enumerate(self.pending.items())
+            ]
+            heapq.heapify(heap)
+            urls = []
+            while heap and len(urls) < n:
+                _score, _order, key = heapq.heappop(heap)
+                url, base = self.pending.pop(key)
+                self.taken[url] = [key, base]
+                urls.append(url)
+        return urls
+
+    def requeue(self) -> int:
+        """
+        Put back the URLs popped but not processed, e.g. those an iteration
+        left once k tuples were reached, so a resumed run still gets to them
+        Returns:
+            int - the number of URLs put back
+        """
+        with self.lock:
+            taken, self.taken = self.taken, {}
+            for url, (key, base) in taken.items():
+                if key in self.pending:
+                    self.pending[key][1] += base
+                else:
+                    self.pending[key] = [url, base]
+        return len(taken)
+
+    def record(self, url: str, relations: int) -> None:
+        """
+        Count a processed page of the URL's host
+        Parameters:
+            url: the URL of the page
+            relations: the number of new relations the page gave (0 if it failed)
+        """
+        with self.lock:
+            if self.taken.pop(url, None) is None:
+                # Put back unprocessed, then processed after all (e.g. by a worker).
+                self.pending.pop(canonical_url(url), None)
+            stats = self.hosts.setdefault(self.host(url), HostStats())
+            stats.pages += 1
+            stats.relations += relations
+            self.pages += 1
+            self.relations += relations
+
+    def state(self) -> Dict:
+        """
+        Returns: the pending URLs and host yields, JSON-serializable (for a checkpoint)
+        """
+        with self.lock:
+            return {
+                "pending": {key: list(entry) for key, entry in self.pending.items()},
+                "hosts": {
+                    host: [stats.pages, stats.relations]
+                    for host, stats in self.hosts.items()
+                },
+            }
+
+    def restore(self, state: Dict) -> None:
+        """
+        Replace the frontier's contents by a state returned by state()
+        """
+        with self.lock:
+            self.pending = {key: list(entry) for key, entry in state["pending"].items()}
+            self.taken = {}
+            self.hosts = {}
+            for host, (pages, relations) in state["hosts"].items():
+                stats = self.hosts[host] = HostStats()
+                stats.pages = pages
+                stats.relations = relations
+            self.pages = sum(stats.pages for stats in self.hosts.values())
+            self.relations = sum(stats.relations for stats in self.hosts.values())
+
+    def report(self) -> str:
+        """
+        Returns: the yield of every host processed, most relations first
+        """
+        lines = [f"{'host':<40} {'pages':>6} {'relations':>10} {'per page':>9}"]
+        for host, stats in sorted(
+            self.hosts.items(), key=lambda item: (-item[1].relations, item[1].pages)
+        ):
+            lines.append(
+                f"{host[:40]:<40} {stats.pages:>6} {stats.relations:>10}"
+                f" {stats.relations / stats.pages:>9.2f}"
+            )
+        lines.append(f"URLs still queued: {len(self.pending)}")
+        return "\n".join(lines)
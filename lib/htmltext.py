@@ -0,0 +1,181 @@
+"""
+Streaming extraction of <p> text from HTML responses
+"""
+import codecs
+import re
+from html.parser import HTMLParser
+from typing import Optional, Tuple
+
+from lib.normalize import TextNormalizer
+
+# Closing one of these ends any <p> left open inside it, as an HTML tree builder would.
+BLOCK_CONTAINERS = {
+    "article",
+    "aside",
+    "blockquote",
+    "body",
+    "div",
+    "footer",
+    "header",
+    "li",
+    "main",
+    "nav",
+    "section",
+    "td",
+    "th",
+}
+
+
+# The number of leading body bytes the encoding is sniffed from (the HTML prescan length).
+SNIFF_BYTES = 1024
+# Byte order marks, longest first (the UTF-32 LE mark starts with the UTF-16 LE one).
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+# <meta charset="..."> and <meta http-equiv="Content-Type" content="...; charset=...">
+META_CHARSET = re.compile(rb"""<meta[^>]*?charset\s*=\s*["']?\s*([a-z0-9_.:-]+)""", re.I)
+# Labels that browsers decode as windows-1252, a superset.
+WINDOWS_1252 = {"ascii", "us-ascii", "iso-8859-1", "iso8859-1", "latin-1", "latin1"}
+
+
+def sniff_encoding(head: bytes, declared: Optional[str] = None) -> str:
+    """
+    Choose the encoding of an HTML body from its first bytes (SNIFF_BYTES), as a browser would:
+    a byte order mark, else the charset of the Content-Type header, else a
+    <meta> charset, else UTF-8 if the bytes are valid UTF-8, else a guess by
+    chardet/charset_normalizer (the detector behind requests' apparent_encoding,
+    run on these bytes only: apparent_encoding would read the whole body).
+    Parameters:
+        head: the first bytes of the body
+        declared: the charset of the Content-Type header, if any
+    Returns:
+        str - a codec name known to Python
+    """
+    for bom, name in BOMS:
+        if head.startswith(bom):
+            return name
+    meta = META_CHARSET.search(head)
+    candidates = [declared, meta.group(1).decode("ascii") if meta else None]
+    try:
+        head.decode("utf-8")
+        candidates.append("utf-8")
+    except UnicodeDecodeError as e:
+        # Valid up to a multi-byte character cut at the end of head.
+        if e.end == len(head) and e.reason == "unexpected end of data":
+            candidates.append("utf-8")
+    try:
+        from requests.compat import chardet
+
+        candidates.append(chardet.detect(head).get("encoding"))
+    except ImportError:
+        pass
+    for candidate in candidates:
+        if not candidate:
+            continue
+        candidate = candidate.strip().lower()
+        if candidate in WINDOWS_1252:
+            return "cp1252"
+        try:
+            return codecs.lookup(candidate).name
+        except LookupError:
+            continue
+    return "cp1252"
+
+
+class ParagraphTextParser(HTMLParser):
+    "Collects the text inside <p> elements as HTML is fed in, chunk by chunk"
+
+    def __init__(self, normalizer: Optional[TextNormalizer] = None) -> None:
+        """
+        Initialize a ParagraphTextParser object
+        Parameters:
+            normalizer: if given, text is normalized as it is collected
+        Instance Variables:
+            in_paragraph: whether the parser is inside a <p> element
+            parts: the text collected so far
+            length: the number of characters collected so far (after normalization)
+        """
+        super().__init__(convert_charrefs=True)
+        self.in_paragraph = False
+        self.normalizer = normalizer.stream() if normalizer is not None else None
+        self.parts = []
+        self.length = 0
+
+    def handle_starttag(self, tag, attrs) -> None:
+        # <p> cannot nest: a new one implicitly closes the previous one.
+        if tag == "p":
+            self.in_paragraph = True
+
+    def handle_endtag(self, tag) -> None:
+        if tag == "p" or tag in BLOCK_CONTAINERS:
+            self.in_paragraph = False
+
+    def handle_data(self, data) -> None:
+        if self.in_paragraph:
+            if self.normalizer is not None:
+                data = self.normalizer.feed(data)
+            self.parts.append(data)
+            self.length += len(data)
+
+    def text(self) -> str:
+        """
+        Returns: the text collected so far
+        """
+        return "".join(self.parts)
+
+
+def stream_paragraph_text(
+    response,
+    char_budget: int,
+    max_bytes: int,
+    chunk_size: int = 16384,
+    normalizer: Optional[TextNormalizer] = None,
+) -> Tuple[str, int]:
+    """
+    Read a streamed requests response incrementally and collect its <p> text.
+    Downloading stops as soon as char_budget characters of text are collected
+    or max_bytes of the body have been read, whichever comes first.
+    Parameters:
+        response: a requests response opened with stream=True
+        char_budget: the number of text characters needed
+        max_bytes: the maximum number of body bytes to download
+        chunk_size: the number of bytes read at a time
+        normalizer: if given, text is normalized while streaming, so the
+                    budget counts normalized characters
+    Returns:
+        (text, bytes read) - the text is at most char_budget characters long
+    """
+    content_type = response.headers.get("Content-Type", "").lower()
+    declared: Optional[str] = response.encoding if "charset" in content_type else None
+    # The decoder is created once SNIFF_BYTES are buffered (or the body ends).
+    decoder = None
+    head = b""
+
+    parser = ParagraphTextParser(normalizer)
+    read = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        read += len(chunk)
+        if decoder is None:
+            head += chunk
+            if len(head) < SNIFF_BYTES and read < max_bytes:
+                continue
+            decoder = codecs.getincrementaldecoder(sniff_encoding(head, declared))(
+                errors="replace"
+            )
+            chunk = head
+        parser.feed(decoder.decode(chunk))
+        if parser.length >= char_budget or read >= max_bytes:
+            break
+    else:
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(sniff_encoding(head, declared))(
+                errors="replace"
+            )
+            parser.feed(decoder.decode(head))
+        parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    return parser.text()[:char_budget], read
@@ -0,0 +1,150 @@
+"""
+Logging for ISE runs. Progress and per-relation details are log records with
+levels instead of unconditional prints, and records are written to stdout by a
+background thread, so extraction does not wait on the terminal or log pipeline.
+Modes:
+    verbose: every progress line, as plain text (the original output)
+    quiet: iterations, URLs, per-page summaries and warnings, plus one line per relation
+    json: the quiet records as JSON lines; a relation is {"event": "relation", ...}
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from typing import Optional, Tuple
+
+LOG_MODES = ["verbose", "quiet", "json"]
+# Added or raised relations, one compact record each.
+RELATIONS_LOGGER = "ise.relations"
+
+# Seconds flush() waits for the writer thread at most.
+FLUSH_TIMEOUT = 10.0
+
+_listener: Optional["ISEListener"] = None
+_lock = threading.Lock()
+
+
+def getLogger(name: str) -> logging.Logger:
+    """
+    Returns: the logger of an ISE module, under the "ise" logger configured by configure()
+    """
+    return logging.getLogger(f"ise.{name}")
+
+
+def logRelation(
+    extractor: str, relation: Tuple[str, str], confidence: Optional[float] = None, **fields
+) -> None:
+    """
+    Log the compact record of a relation added to (or raised in) the extracted set
+    Parameters:
+        extractor: "spanbert" or "gpt3"
+        relation: (subject, object)
+        confidence: the SpanBERT confidence (None for GPT-3)
+        fields: more fields of the record, e.g. updated=True
+    """
+    record = {"extractor": extractor, "subj": relation[0], "obj": relation[1]}
+    if confidence is not None:
+        record["confidence"] = float(confidence)
+    record.update(fields)
+    logging.getLogger(RELATIONS_LOGGER).info("relation", extra={"relation": record})
+
+
+class ISEFormatter(logging.Formatter):
+    "Plain text (the message alone) or one JSON object per record"
+
+    def __init__(self, mode: str) -> None:
+        super().__init__()
+        self.mode = mode
+
+    def format(self, record: logging.LogRecord) -> str:
+        relation = getattr(record, "relation", None)
+        if self.mode == "json":
+            if relation is not None:
+                data = {"time": record.created, "event": "relation", **relation}
+            else:
+                data = {
+                    "time": record.created,
+                    "level": record.levelname,
+                    "logger": record.name,
+                    "msg": record.getMessage().strip(),
+                }
+            return json.dumps(data)
+        if relation is not None:
+            text = f"Relation: {relation['subj']} | {relation['obj']}"
+            if "confidence" in relation:
+                text += f" | {relation['confidence']:.4f}"
+            return text
+        return record.getMessage()
+
+
+class DropRelations(logging.Filter):
+    "Verbose mode already shows every relation in full"
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not record.name.startswith(RELATIONS_LOGGER)
+
+
+class ISEListener(logging.handlers.QueueListener):
+    "Writes queued records; a record with a flushed Event marks a flush() point"
+
+    def handle(self, record: logging.LogRecord) -> None:
+        flushed = getattr(record, "flushed", None)
+        if flushed is None:
+            super().handle(record)
+            return
+        for handler in self.handlers:
+            handler.flush()
+        flushed.set()
+
+
+def configure(mode: str = "verbose", stream=None) -> None:
+    """
+    Route the "ise" loggers through a queue to a writer thread
+    Parameters:
+        mode: one of LOG_MODES
+        stream: where records are written (sys.stdout if None)
+    """
+    global _listener
+    if mode not in LOG_MODES:
+        raise ValueError(f"unknown log mode: {mode}")
+    shutdown()
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(ISEFormatter(mode))
+    if mode == "verbose":
+        handler.addFilter(DropRelations())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    logger = logging.getLogger("ise")
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    logger.setLevel(logging.DEBUG if mode == "verbose" else logging.INFO)
+    logger.propagate = False
+    listener = ISEListener(records, handler)
+    listener.start()
+    with _lock:
+        _listener = listener
+
+
+def flush() -> None:
+    """
+    Wait until every record logged so far is written, e.g. before printing a report.
+    Safe to call from several threads: the writer thread keeps running.
+    """
+    listener = _listener
+    if listener is None:
+        return
+    flushed = threading.Event()
+    # Queued behind every record logged so far, so they are written when it is handled.
+    listener.queue.put_nowait(logging.makeLogRecord({"flushed": flushed}))
+    flushed.wait(FLUSH_TIMEOUT)
+
+
+def shutdown() -> None:
+    """
+    Write the remaining records and stop the writer thread
+    """
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,280 @@
+"""
+Per-stage timings and counters of an ISE run, written at the end of the run
+as JSON lines or in the Prometheus text format.
+Instrumentation wraps the methods of one QueryExecutor and its extractor, so
+a run without -metrics runs the original methods untouched.
+"""
+import json
+import math
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, math.inf)
+
+# What each stage times, recorded with the stage in JSON lines.
+STAGES = {
+    "search": "QueryExecutor.getQueryResult",
+    "fetch": "QueryExecutor.loadPage (page cache or download)",
+    "parse": "QueryExecutor.extractText (normalize, trim, near-duplicate check)",
+    "annotate": "spaCy nlp(text) / nlp.pipe",
+    "pairs": "RelationTypeIndex.candidatePairs (create_entity_pairs)",
+    "spanbert": "SpanBERT predictions of a page's candidate pairs",
+    "gpt3": "gpt3Extractor.gpt3_complete (completion cache or API)",
+    "llm_request": "OpenAI completion requests",
+}
+
+
+class StageTimer:
+    "The latency histogram of one stage"
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class Metrics:
+    "Stage latencies and counters ({name: {labels: value}}) collected during a run"
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.stages: Dict[str, StageTimer] = {}
+        self.counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """
+        Record the duration of one call of a stage
+        """
+        with self.lock:
+            self.stages.setdefault(stage, StageTimer()).observe(seconds)
+
+    def add(self, name: str, value: float, **labels: str) -> None:
+        """
+        Add to a counter, e.g. add("bytes_total", 512, stage="fetch")
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def wrap(
+        self,
+        owner,
+        name: str,
+        stage: str,
+        count: Optional[Callable[..., None]] = None,
+    ) -> None:
+        """
+        Replace a method of an object by one that times each call as stage
+        Parameters:
+            owner: the object (its class and other instances are unaffected)
+            name: the method's name
+            stage: the stage the calls are recorded under
+            count: called as count(result, *args) after each call, to add counters
+        """
+        method = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                self.observe(stage, time.perf_counter() - started)
+            if count is not None:
+                count(result, *args)
+            return result
+
+        setattr(owner, name, timed)
+
+    def instrumentExecutor(self, executor) -> None:
+        """
+        Instrument the search and page stages of a QueryExecutor
+        """
+
+        def searched(items, query, k):
+            self.add("items_total", len(items), stage="search", unit="results")
+
+        def loaded(page, session, url):
+            text, cached = page
+            self.add("items_total", 1, stage="fetch", unit="pages")
+            self.add("pages_total", 1, source="cache" if cached else "download")
+            if text:
+                self.add("chars_total", len(text), stage="fetch")
+
+        def parsed(text, url, page):
+            self.add("items_total", 1 if text else 0, stage="parse", unit="pages")
+            if text:
+                self.add("chars_total", len(text), stage="parse")
+
+        self.wrap(executor, "getQueryResult", "search", searched)
+        self.wrap(executor, "loadPage", "fetch", loaded)
+        self.wrap(executor, "extractText", "parse", parsed)
+
+    def instrumentExtractor(self, extractor) -> None:
+        """
+        Instrument the spaCy, entity pair and model stages of an extractor.
+        Shared models (e.g. the extraction server's) are not wrapped themselves.
+        """
+
+        def annotated(doc, text):
+            self.add("chars_total", len(text), stage="annotate")
+
+        def annotatedBatch(docs, texts):
+            self.add(
+                "chars_total", sum(len(text) for text in texts), stage="annotate"
+            )
+
+        def paired(pairs, sentence):
+            self.add("items_total", 1, stage="pairs", unit="sentences")
+            self.add("items_total", len(pairs), stage="pairs", unit="pairs")
+
+        self.wrap(extractor, "annotate", "annotate", annotated)
+        self.wrap(extractor, "annotate_batch", "annotate", annotatedBatch)
+        self.wrap(extractor.type_index, "candidatePairs", "pairs", paired)
+        if hasattr(extractor, "extract_entity_relation_preds"):
+
+            def scored(preds, candidate_pairs):
+                self.add(
+                    "items_total", len(candidate_pairs), stage="spanbert", unit="pairs"
+                )
+
+            self.wrap(extractor, "extract_entity_relation_preds", "spanbert", scored)
+        if hasattr(extractor, "gpt3_complete"):
+
+            def completed(text, prompt, max_tokens=None):
+                # ~4 characters per token, as the rate limiter estimates.
+                self.add("tokens_total", len(prompt) // 4, stage="gpt3", kind="prompt")
+                if text:
+                    self.add(
+                        "tokens_total", len(text) // 4, stage="gpt3", kind="completion"
+                    )
+
+            self.wrap(extractor, "gpt3_complete", "gpt3", completed)
+            self.wrap(extractor.dispatcher, "complete", "llm_request")
+
+    def collect(self, executor) -> None:
+        """
+        Copy the cache and deduplication counters of a finished run
+        """
+        caches = {
+            "search": executor.search_cache,
+            "page": executor.page_cache,
+            "sentence": executor.sentence_store,
+            "completion": getattr(executor._extractor, "completion_cache", None),
+        }
+        for name, cache in caches.items():
+            if cache is not None:
+                self.add("cache_hits_total", cache.hits, cache=name)
+                self.add("cache_misses_total", cache.misses, cache=name)
+        self.add("duplicates_total", executor.duplicate_urls, kind="url")
+        if executor.near_duplicates is not None:
+            self.add("duplicates_total", executor.near_duplicates.skipped, kind="page")
+        extractor = executor._extractor
+        if extractor is None:
+            return
+        self.add(
+            "cache_hits_total", extractor.sentence_index.repeats, cache="sentence_index"
+        )
+        self.add(
+            "items_total",
+            extractor.type_index.skipped,
+            stage="pairs",
+            unit="skipped_sentences",
+        )
+        self.add("relations", len(extractor.relations))
+
+    def records(self) -> List[Dict]:
+        """
+        Returns: one JSON-serializable record per stage and per counter series
+        """
+        records = []
+        with self.lock:
+            for stage, timer in self.stages.items():
+                records.append(
+                    {
+                        "type": "stage",
+                        "stage": stage,
+                        "wraps": STAGES.get(stage, stage),
+                        "count": timer.count,
+                        "sum_s": timer.sum,
+                        "mean_ms": 1000 * timer.sum / max(timer.count, 1),
+                        "max_ms": 1000 * timer.max,
+                        "buckets": {
+                            str(bound): n for bound, n in zip(BUCKETS, timer.buckets)
+                        },
+                    }
+                )
+            for name, series in self.counters.items():
+                for labels, value in series.items():
+                    records.append(
+                        {
+                            "type": "counter",
+                            "name": name,
+                            "labels": dict(labels),
+                            "value": value,
+                        }
+                    )
+        return records
+
+    def jsonLines(self) -> str:
+        return "".join(json.dumps(record) + "\n" for record in self.records())
+
+    def prometheus(self) -> str:
+        """
+        Returns: the metrics in the Prometheus text exposition format, prefixed "ise_"
+        """
+
+        def labelText(labels: Dict[str, str]) -> str:
+            if not labels:
+                return ""
+            pairs = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            return "{" + pairs + "}"
+
+        lines = [
+            "# HELP ise_stage_seconds Duration of the calls of each ISE stage.",
+            "# TYPE ise_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, timer in self.stages.items():
+                cumulative = 0
+                for bound, n in zip(BUCKETS, timer.buckets):
+                    cumulative += n
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(
+                        f'ise_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}'
+                    )
+                lines.append(f'ise_stage_seconds_sum{{stage="{stage}"}} {timer.sum}')
+                lines.append(f'ise_stage_seconds_count{{stage="{stage}"}} {timer.count}')
+            for name, series in self.counters.items():
+                kind = "counter" if name.endswith("_total") else "gauge"
+                lines.append(f"# TYPE ise_{name} {kind}")
+                for labels, value in series.items():
+                    lines.append(f"ise_{name}{labelText(dict(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, fmt: str = "jsonl") -> None:
+        """
+        Write the metrics to a file ("-": standard output)
+        Parameters:
+            path: the file to write
+            fmt: "jsonl" (one JSON object per line) or "prometheus"
+        """
+        text = self.prometheus() if fmt == "prometheus" else self.jsonLines()
+        if path == "-":
+            sys.stdout.write(text)
+            return
+        with open(path, "w") as f:
+            f.write(text)
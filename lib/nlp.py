@@ -0,0 +1,49 @@
+"""
+spaCy pipeline loading and batched annotation shared by the extractors
+"""
+from typing import Iterable, List
+
+import spacy
+
+# The extractors only read sentence boundaries (parser) and named entities (ner),
+# for every relation. These components feed neither of them.
+UNUSED_COMPONENTS = ["tagger", "attribute_ruler", "lemmatizer"]
+
+
+def load_pipeline(model: str = "en_core_web_sm", fast_sentences: bool = False):
+    """
+    Load a spaCy pipeline slimmed down to what relation extraction needs
+    Parameters:
+        model: the spaCy model to load
+        fast_sentences: if True, split sentences with the statistical "senter"
+                        component instead of the (slower) dependency parser.
+                        Sentence boundaries may differ slightly.
+    Returns:
+        nlp: the spaCy pipeline
+    """
+    nlp = spacy.load(model, exclude=UNUSED_COMPONENTS)
+    if fast_sentences and "senter" in nlp.disabled:
+        nlp.disable_pipe("parser")
+        nlp.enable_pipe("senter")
+    return nlp
+
+
+def annotate_batch(
+    nlp, texts: Iterable[str], batch_size: int = 8, n_process: int = 1
+) -> List:
+    """
+    Annotate several texts in one nlp.pipe call.
+    With n_process > 1, spaCy starts a new pool of processes for every call,
+    each loading a copy of the pipeline: this is opt-in, and only pays off for
+    large batches. A call never starts more processes than it has texts.
+    Parameters:
+        nlp: the spaCy pipeline
+        texts: the texts to annotate
+        batch_size: the number of texts spaCy processes together
+        n_process: the maximum number of worker processes spaCy uses
+    Returns:
+        docs: the spaCy documents, in the same order as texts
+    """
+    texts = list(texts)
+    n_process = max(1, min(n_process, len(texts)))
+    return list(nlp.pipe(texts, batch_size=batch_size, n_process=n_process))
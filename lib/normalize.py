@@ -0,0 +1,97 @@
+"""
+Single-pass whitespace collapsing and invisible-character stripping of webpage text
+"""
+import re
+from typing import Iterable
+
+# Runs of these characters collapse to a single space.
+WHITESPACE = " \t\n\r\f\v\u00a0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000"
+# These characters are removed: zero-width spaces/joiners, word joiner, BOM, soft hyphen.
+INVISIBLE = "\u200b\u200c\u200d\u2060\ufeff\u00ad"
+
+
+class TextNormalizer:
+    """
+    Collapses whitespace runs to one space and strips invisible characters in
+    one compiled regular expression pass.
+    """
+
+    def __init__(
+        self, whitespace: Iterable[str] = WHITESPACE, invisible: Iterable[str] = INVISIBLE
+    ) -> None:
+        """
+        Initialize a TextNormalizer object
+        Parameters:
+            whitespace: the characters collapsed to a single space (always includes " ")
+            invisible: the characters removed
+        """
+        # A space is always whitespace: collapsed runs are replaced by one.
+        whitespace = " " + "".join(whitespace).replace(" ", "")
+        invisible = "".join(invisible)
+        if set(whitespace) & set(invisible):
+            raise ValueError("a character cannot be both whitespace and invisible")
+        self.whitespace = whitespace
+        self.invisible = invisible
+        self.delete = str.maketrans("", "", invisible)
+        either = re.escape(whitespace + invisible)
+        not_space = re.escape(whitespace.replace(" ", "") + invisible)
+        # A lone space is already normal and is not matched. Any other run starts
+        # either with a non-space character or with a space followed by more.
+        # Both branches start with a character class, which lets the regex
+        # engine skip ahead between matches instead of trying every position.
+        if not_space:
+            self.pattern = re.compile(f"[{not_space}][{either}]*| [{either}]+")
+        else:
+            self.pattern = re.compile(" {2,}")
+
+    def replace(self, match: "re.Match") -> str:
+        # A run made only of invisible characters disappears, so that
+        # "zero\u200bwidth" stays one word; any whitespace in it leaves a space.
+        return " " if match.group().translate(self.delete) else ""
+
+    def normalize(self, text: str) -> str:
+        """
+        Parameters:
+            text: the text to normalize
+        Returns:
+            str - the text with whitespace runs collapsed and invisible characters removed
+        """
+        return self.pattern.sub(self.replace, text)
+
+    def stream(self) -> "StreamingNormalizer":
+        """
+        Returns: a StreamingNormalizer applying these rules to text fed in pieces
+        """
+        return StreamingNormalizer(self)
+
+
+class StreamingNormalizer:
+    """
+    Normalizes text arriving in pieces (e.g. parser callbacks), so that a
+    whitespace run split across two pieces still collapses to one space.
+    """
+
+    def __init__(self, normalizer: TextNormalizer) -> None:
+        """
+        Initialize a StreamingNormalizer object
+        Parameters:
+            normalizer: the rules applied to every piece
+        Instance Variables:
+            ends_with_space: whether the text emitted so far ends with a space
+        """
+        self.normalizer = normalizer
+        self.ends_with_space = False
+
+    def feed(self, piece: str) -> str:
+        """
+        Parameters:
+            piece: the next piece of text
+        Returns:
+            str - the normalized continuation of the text emitted so far
+        """
+        piece = self.normalizer.normalize(piece)
+        if self.ends_with_space and piece.startswith(" "):
+            piece = piece[1:]
+        if piece:
+            self.ends_with_space = piece.endswith(" ")
+        return piece
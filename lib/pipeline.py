@@ -0,0 +1,225 @@
+"""
+Producer/consumer pipeline for the QueryExecutor:
+fetch -> parse -> annotate (spaCy) -> extract (SpanBERT / GPT-3)
+"""
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+from lib.log import getLogger
+
+log = getLogger("pipeline")
+
+# Marks the end of a stage's input.
+DONE = object()
+
+
+class StageStats:
+    "Throughput counters for one pipeline stage"
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.max_depth = 0
+
+    def record(self, started: float, depth: int = 0, count: int = 1) -> None:
+        """
+        Record processed items
+        Parameters:
+            started: the perf_counter() value when work on the items began
+            depth: the size of the stage's input queue when the items were taken
+            count: the number of items processed since started
+        """
+        self.items += count
+        self.busy += time.perf_counter() - started
+        self.max_depth = max(self.max_depth, depth)
+
+    def throughput(self) -> float:
+        """
+        Returns: items processed per busy second
+        """
+        return self.items / self.busy if self.busy else 0.0
+
+
+class ExtractionPipeline:
+    "Overlaps network I/O, HTML parsing, spaCy annotation and relation extraction"
+
+    def __init__(self, executor, queue_depth: int = 4, batch_size: int = 1) -> None:
+        """
+        Initialize an ExtractionPipeline object
+        Parameters:
+            executor: the QueryExecutor owning the fetcher and the extractor
+            queue_depth: the maximum number of items waiting between two stages
+            batch_size: the maximum number of waiting pages annotated by spaCy at once
+        Instance Variables:
+            stats: a dictionary of per-stage counters {stage name: StageStats}
+            stop: set once the run should be abandoned (e.g. k tuples reached)
+            error: the exception that ended a stage thread, re-raised by run()
+        """
+        self.executor = executor
+        self.queue_depth = queue_depth
+        self.batch_size = batch_size
+        self.stats: Dict[str, StageStats] = {
+            name: StageStats(name) for name in ("fetch", "parse", "annotate", "extract")
+        }
+        self.stop = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def fail(self, error: BaseException) -> None:
+        """
+        Record the exception of a stage thread and stop the pipeline
+        """
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def put(self, q: queue.Queue, item) -> bool:
+        """
+        Put an item on a bounded queue, giving up if the pipeline is stopped
+        Returns: bool (True if the item was queued)
+        """
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q: queue.Queue):
+        """
+        Take an item from a queue, returning DONE if the pipeline is stopped
+        """
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return DONE
+
+    def fetchStage(self, ranks: Dict[str, int], out: queue.Queue) -> None:
+        started = time.perf_counter()
+        pages = self.executor.fetcher.fetchAll(ranks, self.executor.loadPage)
+        try:
+            for url, page in pages:
+                self.stats["fetch"].record(started)
+                if not self.put(out, (url, page)):
+                    break
+                started = time.perf_counter()
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            pages.close()
+            self.put(out, DONE)
+
+    def parseStage(self, inp: queue.Queue, out: queue.Queue) -> None:
+        try:
+            while True:
+                item = self.get(inp)
+                if item is DONE:
+                    break
+                started = time.perf_counter()
+                url, page = item
+                text = self.executor.extractText(url, page)
+                self.stats["parse"].record(started, inp.qsize())
+                if text and not self.put(out, (url, text)):
+                    break
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            self.put(out, DONE)
+
+    def annotateStage(self, inp: queue.Queue, out: queue.Queue) -> None:
+        try:
+            while True:
+                item = self.get(inp)
+                if item is DONE:
+                    break
+                depth = inp.qsize()
+                # Annotate whatever else is already waiting together with this page.
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        item = inp.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is DONE:
+                        break
+                    batch.append(item)
+                started = time.perf_counter()
+                urls = [url for url, _text in batch]
+                texts = [text for _url, text in batch]
+                if len(texts) == 1:
+                    docs = [self.executor.extractor.annotate(texts[0])]
+                else:
+                    docs = self.executor.extractor.annotate_batch(texts)
+                self.stats["annotate"].record(started, depth, len(docs))
+                if not all(self.put(out, pair) for pair in zip(urls, docs)):
+                    break
+                if item is DONE:
+                    break
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            self.put(out, DONE)
+
+    def run(self, ranks: Dict[str, int], num_results: int) -> bool:
+        """
+        Push one iteration's URLs through all stages.
+        Extraction runs on the calling thread, so the extractor's relations
+        are only ever modified from one thread.
+        Parameters:
+            ranks: a dictionary of the iteration's URLs and their position {url: position}
+            num_results: the number of URLs in this iteration
+        Returns:
+            bool (True if we need to find more relations, else False)
+        Raises:
+            the exception of a stage thread that failed, once all stages have stopped
+        """
+        self.stop.clear()
+        self.error = None
+        parsed = queue.Queue(self.queue_depth)
+        annotated = queue.Queue(self.queue_depth)
+        docs = queue.Queue(self.queue_depth)
+        workers: List[threading.Thread] = [
+            threading.Thread(target=self.fetchStage, args=(ranks, parsed)),
+            threading.Thread(target=self.parseStage, args=(parsed, annotated)),
+            threading.Thread(target=self.annotateStage, args=(annotated, docs)),
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            while True:
+                item = self.get(docs)
+                if item is DONE:
+                    break
+                started = time.perf_counter()
+                url, doc = item
+                log.info(f"URL ( {ranks[url] + 1} / {num_results}): {url}")
+                self.executor.extractDoc(url, doc)
+                self.stats["extract"].record(started, docs.qsize())
+                if not self.executor.checkContinue():
+                    break
+        finally:
+            # Cancels in-flight work in the upstream stages.
+            self.stop.set()
+            for worker in workers:
+                worker.join()
+        if self.error is not None:
+            raise self.error
+        return self.executor.checkContinue()
+
+    def printStats(self) -> None:
+        """
+        Print per-stage throughput counters
+        """
+        print("================== Pipeline stages =================")
+        for stats in self.stats.values():
+            print(
+                f"{stats.name:<10} items: {stats.items:<6} busy: {stats.busy:8.2f}s"
+                f"  throughput: {stats.throughput():8.2f}/s  max queue depth: {stats.max_depth}"
+            )
@@ -0,0 +1,160 @@
+"""
+Concurrent, rate-limited dispatch of LLM completion requests
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Type
+
+from lib.log import getLogger
+
+log = getLogger("ratelimit")
+
+
+class RateLimiter:
+    "Token buckets for requests per minute and tokens per minute"
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None) -> None:
+        """
+        Initialize a RateLimiter object
+        Parameters:
+            rpm: the requests-per-minute budget (None: unlimited)
+            tpm: the tokens-per-minute budget (None: unlimited)
+        """
+        for name, budget in (("rpm", rpm), ("tpm", tpm)):
+            if budget is not None and budget <= 0:
+                raise ValueError(f"{name} has to be greater than 0, got {budget}")
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm or 0.0
+        self.tokens = tpm or 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self) -> None:
+        # Callers hold self.lock.
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int) -> None:
+        """
+        Block until one request of the given number of tokens fits in both budgets
+        Parameters:
+            tokens: the estimated prompt + completion tokens of the request
+        """
+        if self.tpm:
+            # A request larger than the whole budget would otherwise wait forever.
+            tokens = min(tokens, self.tpm)
+        while True:
+            with self.lock:
+                self.refill()
+                wait = 0.0
+                if self.rpm and self.requests < 1:
+                    wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+                if self.tpm and self.tokens < tokens:
+                    wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+                if wait == 0.0:
+                    if self.rpm:
+                        self.requests -= 1
+                    if self.tpm:
+                        self.tokens -= tokens
+                    return
+            time.sleep(wait)
+
+
+class CompletionDispatcher:
+    "Issues completion requests on a thread pool under a RateLimiter, retrying with backoff"
+
+    def __init__(
+        self,
+        complete: Callable[[str, int], str],
+        workers: int = 4,
+        limiter: Optional[RateLimiter] = None,
+        max_tokens: int = 100,
+        retry_on: Tuple[Type[BaseException], ...] = (),
+        max_retries: int = 5,
+        backoff: float = 1.0,
+    ) -> None:
+        """
+        Initialize a CompletionDispatcher object
+        Parameters:
+            complete: the function turning (prompt, max_tokens) into a completion
+            workers: the maximum number of requests in flight
+            limiter: the request/token budget (None: unlimited)
+            max_tokens: the default completion length, also counted against the token budget
+            retry_on: the exceptions that are retried (e.g. rate-limit errors)
+            max_retries: the number of retries before giving up on a prompt
+            backoff: the first retry delay in seconds; doubled on every retry
+        Instance Variables:
+            retries: the number of retried attempts, over all threads
+            failures: the number of prompts given up on, over all threads
+        """
+        self.complete = complete
+        self.workers = workers
+        self.limiter = limiter or RateLimiter()
+        self.max_tokens = max_tokens
+        self.retry_on = retry_on
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retries = 0
+        self.failures = 0
+        # Guards the counters, updated from the threads of map().
+        self.lock = threading.Lock()
+
+    def estimateTokens(self, prompt: str, max_tokens: int) -> int:
+        """
+        Rough token count of a request: ~4 characters per prompt token plus the completion
+        """
+        return len(prompt) // 4 + max_tokens
+
+    def call(self, prompt: str, max_tokens: Optional[int] = None) -> Optional[str]:
+        """
+        Complete one prompt, retrying with exponential backoff
+        Parameters:
+            prompt: the prompt to complete
+            max_tokens: the maximum completion length (default: self.max_tokens)
+        Returns:
+            str - the completion, or None if every attempt failed
+        """
+        max_tokens = max_tokens or self.max_tokens
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(self.estimateTokens(prompt, max_tokens))
+            try:
+                return self.complete(prompt, max_tokens)
+            except self.retry_on as e:
+                if attempt == self.max_retries:
+                    log.warning(f"Giving up on completion after {attempt + 1} attempts: {e}")
+                    break
+                with self.lock:
+                    self.retries += 1
+                time.sleep(delay)
+                delay *= 2
+        with self.lock:
+            self.failures += 1
+        return None
+
+    def map(
+        self, prompts: List[str], fn: Optional[Callable[[str], Optional[str]]] = None
+    ) -> List[Optional[str]]:
+        """
+        Complete all prompts concurrently
+        Parameters:
+            prompts: the prompts to complete
+            fn: the function run per prompt (default: self.call); a caching
+                wrapper around self.call keeps cache hits off the budget
+        Returns:
+            the completions, in the same order as prompts (None where a prompt failed)
+        """
+        fn = fn or self.call
+        if self.workers == 1 or len(prompts) <= 1:
+            return [fn(prompt) for prompt in prompts]
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="llm"
+        ) as pool:
+            return list(pool.map(fn, prompts))
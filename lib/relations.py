@@ -0,0 +1,114 @@
+"""
+The relations extracted in an ISE run, indexed by confidence so that the
+next iteration's queries are found without sorting all relations again.
+"""
+import heapq
+import sys
+from collections.abc import MutableMapping
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+Relation = Tuple[str, str]
+
+
+class RelationStore(MutableMapping):
+    """
+    A dictionary of relations and their confidence {(subj, obj): confidence}
+    that also tracks which relations were used as queries. A max-heap of the
+    unused relations gives the highest confidence ones first (in insertion
+    order for equal confidences, as a stable sort would). Entries left behind
+    in the heap by raised or used relations are dropped as they surface.
+    """
+
+    def __init__(self, scored: bool = True) -> None:
+        """
+        Initialize a RelationStore object
+        Parameters:
+            scored: False if relations have no confidence (GPT-3): all are stored with 1.0
+        Instance Variables:
+            confidences: the relations and their confidence, in insertion order
+            order: the insertion number of each relation, breaking confidence ties
+            used: the relations already taken by takeUnused
+            heap: (-confidence, order, relation) of unused relations, possibly stale
+        """
+        self.scored = scored
+        self.confidences: Dict[Relation, float] = {}
+        self.order: Dict[Relation, int] = {}
+        self.used: Set[Relation] = set()
+        self.heap: List[Tuple[float, int, Relation]] = []
+
+    @staticmethod
+    def key(relation) -> Relation:
+        """
+        Returns: the (subject, object) key of a relation, with both strings
+                 interned (entities recur across many relations and pages)
+        """
+        subj, obj = relation
+        return sys.intern(subj), sys.intern(obj)
+
+    def __getitem__(self, relation) -> float:
+        return self.confidences[tuple(relation)]
+
+    def __setitem__(self, relation, confidence: float) -> None:
+        key = self.key(relation)
+        if key not in self.order:
+            self.order[key] = len(self.order)
+        self.confidences[key] = confidence
+        if key not in self.used:
+            heapq.heappush(self.heap, (-confidence, self.order[key], key))
+
+    def __delitem__(self, relation) -> None:
+        key = tuple(relation)
+        del self.confidences[key]
+        self.used.discard(key)
+
+    def __iter__(self) -> Iterator[Relation]:
+        return iter(self.confidences)
+
+    def __len__(self) -> int:
+        return len(self.confidences)
+
+    def __contains__(self, relation) -> bool:
+        return tuple(relation) in self.confidences
+
+    def upsert(self, relation, confidence: float = 1.0) -> Optional[float]:
+        """
+        Add a relation, or raise its confidence if it is higher than the stored one
+        Parameters:
+            relation: (subject, object)
+            confidence: the confidence of this extraction of the relation
+        Returns:
+            the confidence stored before (None if the relation is new)
+        """
+        previous = self.confidences.get(tuple(relation))
+        if previous is None or previous < confidence:
+            self[relation] = confidence
+        return previous
+
+    def takeUnused(
+        self, n: int, accept: Optional[Callable[[Relation], bool]] = None
+    ) -> List[Tuple[Relation, float]]:
+        """
+        Take up to n unused relations, highest confidence first, and mark them used
+        Parameters:
+            n: the maximum number of relations
+            accept: called on each candidate; rejected relations are marked used
+                    without being returned (e.g. their query was already issued)
+        Returns:
+            a list of (relation, confidence)
+        """
+        taken = []
+        while self.heap and len(taken) < n:
+            negative, _order, key = heapq.heappop(self.heap)
+            if key in self.used or self.confidences.get(key) != -negative:
+                # Stale: used already, deleted, or superseded by a raised confidence.
+                continue
+            self.used.add(key)
+            if accept is None or accept(key):
+                taken.append((key, -negative))
+        return taken
+
+    def ranked(self) -> List[Tuple[Relation, float]]:
+        """
+        Returns: every relation and its confidence, highest confidence first
+        """
+        return sorted(self.confidences.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,73 @@
+"""
+Streaming output of the relations of an ISE run: every relation is written
+(and flushed) as soon as it passes the threshold, instead of only in the
+table printed at the end of the run.
+"""
+import csv
+import json
+import threading
+from typing import Optional, Tuple
+
+SINK_FORMATS = ["jsonl", "csv"]
+
+
+class RelationSink:
+    """
+    Appends one record per relation added to the run's relations. A SpanBERT
+    relation raised in confidence is written again with "updated" set, so
+    readers keep the last record of each (subject, object).
+    """
+
+    def __init__(self, path: str, fmt: str = "jsonl", append: bool = False) -> None:
+        """
+        Initialize a RelationSink object
+        Parameters:
+            path: the file the relations are written to
+            fmt: "jsonl" (one JSON object per line) or "csv"
+            append: keep the records already in the file (e.g. when resuming a run)
+        Instance Variables:
+            written: the number of records written by this run
+        """
+        if fmt not in SINK_FORMATS:
+            raise ValueError(f"unknown relation output format: {fmt}")
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        self.written = 0
+        self.file = open(path, "a" if append else "w", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file) if fmt == "csv" else None
+        if self.writer is not None and self.file.tell() == 0:
+            self.writer.writerow(["subject", "object", "confidence", "updated"])
+            self.file.flush()
+
+    def write(
+        self,
+        relation: Tuple[str, str],
+        confidence: Optional[float] = None,
+        updated: bool = False,
+    ) -> None:
+        """
+        Write the record of one relation
+        Parameters:
+            relation: (subject, object)
+            confidence: the SpanBERT confidence (None for GPT-3)
+            updated: True if the relation was already written with a lower confidence
+        """
+        subj, obj = relation
+        with self.lock:
+            if self.writer is not None:
+                self.writer.writerow(
+                    [subj, obj, "" if confidence is None else float(confidence), int(updated)]
+                )
+            else:
+                record = {"subject": subj, "object": obj}
+                if confidence is not None:
+                    record["confidence"] = float(confidence)
+                record["updated"] = updated
+                self.file.write(json.dumps(record) + "\n")
+            # Flushed per record: a crash loses at most the record being written.
+            self.file.flush()
+            self.written += 1
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
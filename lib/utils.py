@@ -77,6 +77,16 @@ PROMPT_AIDS = {
     4: "COMPANY Top_Member_Employees PERSON. Output the following: [ORGANIZATION:COMPANY, RELATION:Top_Member_Employees, PERSON:PERSON]. Ensure ORGANIZATION is a Company.",
 }
 
+# SpanBERT entity types -> the spaCy labels they come from, as in spacy_help_functions.bert2spacy.
+SPACY_LABELS = {
+    "ORGANIZATION": "ORG",
+    "PERSON": "PERSON",
+    "LOCATION": "LOC",
+    "CITY": "GPE",
+    "COUNTRY": "GPE",
+    "STATE_OR_PROVINCE": "GPE",
+}
+
 SUBJ_OBJ_REQUIRED_ENTITIES = {
     1: {"SUBJ": ["PERSON"], "OBJ": ["ORGANIZATION"]},
     2: {"SUBJ": ["PERSON"], "OBJ": ["ORGANIZATION"]},
@@ -104,6 +114,13 @@ def tValue(string) -> float:
     return value
 
 
+def similarityValue(string) -> float:
+    value = float(string)
+    if value < 0 or value > 1:
+        raise argparse.ArgumentTypeError("similarity has to be a float between 0 and 1")
+    return value
+
+
 def rValue(string) -> int:
     value = int(string)
     if value < 1 or value > 4:
@@ -116,3 +133,17 @@ def kValue(string) -> int:
     if value < 1:
         raise argparse.ArgumentTypeError("k value has to be an integer greater than 0")
     return value
+
+
+def positiveInt(string) -> int:
+    value = int(string)
+    if value < 1:
+        raise argparse.ArgumentTypeError("value has to be an integer greater than 0")
+    return value
+
+
+def positiveFloat(string) -> float:
+    value = float(string)
+    if not 0 < value < float("inf"):
+        raise argparse.ArgumentTypeError("value has to be a finite number greater than 0")
+    return value
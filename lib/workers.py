@@ -0,0 +1,307 @@
+"""
+Multi-process extraction: search results are sharded to worker processes that
+each hold their own spaCy/SpanBERT (or GPT-3 client), and the relations they
+extract are merged into the coordinating QueryExecutor's extractor.
+"""
+import copy
+import multiprocessing
+import queue
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from lib import log as ise_log
+
+log = ise_log.getLogger("workers")
+
+# Seconds after which the URLs of an iteration still unfinished are abandoned.
+ITERATION_TIMEOUT = 600.0
+
+
+def relation_delta(before, after) -> List[Tuple]:
+    """
+    The relations added or raised in confidence between a snapshot of an
+    extractor's relations and its RelationStore
+    Returns:
+        [(subj, obj, confidence), ...] for SpanBERT,
+        [(subj, obj), ...] for GPT-3 (relations without confidence)
+    """
+    if after.scored:
+        return [
+            (subj, obj, float(confidence))
+            for (subj, obj), confidence in after.items()
+            if before.get((subj, obj)) != confidence
+        ]
+    return [relation for relation in after if relation not in before]
+
+
+def snapshot(relations) -> Dict:
+    """
+    Returns: a copy of an extractor's relations to diff against with relation_delta
+    """
+    return dict(relations)
+
+
+def work(worker_id: int, args, tasks, results, stop, models=None) -> None:
+    """
+    Worker process: load the extractor (with the models built by models(), if
+    given), then process URLs from tasks until a None task arrives. For every
+    URL, ("taken", worker, url) is sent before processing and ("done", worker,
+    url, relations) after it, where relations are those added or raised on
+    that page; ("skipped", worker, url) replaces the latter once stop is set.
+    """
+    from QueryExecutor import QueryExecutor
+
+    ise_log.configure(getattr(args, "log", "verbose"))
+    executor = QueryExecutor(args, models=models() if models is not None else None)
+    executor.loadExtractor()
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            url, rank, num_results = task
+            results.put(("taken", worker_id, url))
+            if stop.is_set():
+                # Left for the coordinator to put back in the frontier.
+                results.put(("skipped", worker_id, url))
+                continue
+            delta = []
+            log.info(f"URL ( {rank + 1} / {num_results}) [worker {worker_id}]: {url}")
+            try:
+                before = snapshot(executor.extractor.relations)
+                text = executor.extractText(
+                    url, executor.loadPage(executor.fetcher.session, url)
+                )
+                if text:
+                    executor.extractor.get_relations_from_doc(
+                        executor.extractor.annotate(text)
+                    )
+                delta = relation_delta(before, executor.extractor.relations)
+            except Exception as e:
+                log.warning(
+                    f"Error processing {url} in worker {worker_id}: {e}. Moving on ..."
+                )
+            results.put(("done", worker_id, url, delta))
+    finally:
+        executor.close()
+        ise_log.shutdown()
+
+
+class ShardedExtraction:
+    """
+    Shares the URLs of each iteration between the coordinating process and
+    worker processes. URLs go through one task queue, so a process that
+    finishes early takes the next URL. The coordinator merges every page's
+    relations into its own extractor (max confidence for SpanBERT) and stops
+    all processes once k relations are known.
+    """
+
+    def __init__(
+        self,
+        executor,
+        processes: int,
+        timeout: float = ITERATION_TIMEOUT,
+        models: Optional[Callable[[], Dict]] = None,
+    ) -> None:
+        """
+        Initialize a ShardedExtraction object and start the worker processes
+        Parameters:
+            executor: the coordinating QueryExecutor; it processes URLs too
+            processes: the number of worker processes besides the coordinator
+            timeout: the seconds after which an iteration's unfinished URLs are abandoned
+            models: a picklable function called in each worker to build its models
+                    (e.g. stand-ins for a benchmark; None: workers load their own)
+        Instance Variables:
+            workers: the worker processes still alive
+            died: the workers that died
+            inflight: the URL each worker is processing {worker: url}
+            outstanding: the URLs of the current iteration not finished yet
+            pages: the number of pages processed per process {worker (0: coordinator): pages}
+            merged: the number of relations merged from each worker {worker: relations}
+        """
+        self.executor = executor
+        self.timeout = timeout
+        # spawn: spaCy/torch state is not safely shared with fork.
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.stop = context.Event()
+        worker_args = copy.copy(executor.args)
+        worker_args.processes = 1
+        worker_args.metrics = None
+        # The coordinator streams, checkpoints and resumes the merged relations.
+        worker_args.relations_out = None
+        worker_args.checkpoint = None
+        worker_args.resume = False
+        self.workers = {
+            i: context.Process(
+                target=work,
+                args=(i, worker_args, self.tasks, self.results, self.stop, models),
+                name=f"ise-worker-{i}",
+                daemon=True,
+            )
+            for i in range(1, processes + 1)
+        }
+        for process in self.workers.values():
+            process.start()
+        self.died: Set[int] = set()
+        self.inflight: Dict[int, Optional[str]] = {}
+        self.outstanding: Dict[str, int] = {}
+        self.pages: Dict[int, int] = {i: 0 for i in range(processes + 1)}
+        self.merged: Dict[int, int] = {i: 0 for i in range(1, processes + 1)}
+
+    def run(self, ranks: Dict[str, int], num_results: int) -> bool:
+        """
+        Process the URLs of one iteration across all processes
+        Parameters:
+            ranks: the URLs of the iteration and their position {url: position}
+            num_results: the number of URLs in the iteration
+        Returns:
+            bool (True if we need to find more relations, else False)
+        """
+        self.outstanding = dict(ranks)
+        for url, rank in ranks.items():
+            self.tasks.put((url, rank, num_results))
+        deadline = time.monotonic() + self.timeout
+        while self.outstanding:
+            self.collect(block=False)
+            if not self.executor.checkContinue():
+                return self.halt()
+            if not self.outstanding:
+                break
+            if time.monotonic() > deadline:
+                log.error(
+                    f"Abandoning {len(self.outstanding)} URLs still unfinished after {self.timeout:.0f}s"
+                )
+                self.abandon()
+                break
+            try:
+                url, rank, _ = self.tasks.get_nowait()
+            except queue.Empty:
+                # Every URL is taken: wait for the workers.
+                if not self.collect(block=True):
+                    self.requeueOrphans(num_results)
+                continue
+            if url not in self.outstanding:
+                # Requeued, but finished by its first taker meanwhile.
+                continue
+            log.info(f"URL ( {rank + 1} / {num_results}): {url}")
+            text = self.executor.extractText(
+                url, self.executor.loadPage(self.executor.fetcher.session, url)
+            )
+            if text:
+                self.executor.extractBatch([(url, text)])
+            self.pages[0] += 1
+            del self.outstanding[url]
+        return self.executor.checkContinue() or self.halt()
+
+    def requeueOrphans(self, num_results: int) -> None:
+        """
+        Queue again the URLs taken by workers that died before announcing them.
+        Called once the task queue is empty and no message arrived for a second:
+        an unfinished URL that no live worker is processing was lost with a dead one.
+        Without workers left, the coordinator processes them itself.
+        """
+        if not self.died:
+            return
+        held = {self.inflight.get(worker) for worker in self.workers}
+        orphans = [url for url in self.outstanding if url not in held]
+        if not orphans:
+            return
+        if not self.workers:
+            log.error(
+                f"All worker processes died; {len(self.outstanding)} URLs are left to the coordinator"
+            )
+        else:
+            log.warning(f"Requeueing {len(orphans)} URLs taken by workers that died")
+        for url in orphans:
+            self.tasks.put((url, self.outstanding[url], num_results))
+
+    def abandon(self) -> None:
+        """
+        Give up on the current iteration's unfinished URLs: unqueue those not taken
+        yet. Pages still being processed are merged when they finish, but no longer
+        awaited.
+        """
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except queue.Empty:
+                break
+        self.outstanding = {}
+
+    def collect(self, block: bool) -> int:
+        """
+        Merge the relations of the pages the workers have finished
+        Parameters:
+            block: wait (up to a second) for the next message if none is queued
+        Returns:
+            int - the number of the iteration's URLs finished (or lost with a worker that died)
+        """
+        finished = 0
+        timeout = 1.0 if block else 0.0
+        while True:
+            try:
+                message = self.results.get(timeout=timeout) if block else self.results.get_nowait()
+            except queue.Empty:
+                break
+            block = False
+            if message[0] == "taken":
+                self.inflight[message[1]] = message[2]
+                continue
+            if message[0] == "skipped":
+                self.inflight[message[1]] = None
+                continue
+            _, worker, url, delta = message
+            self.inflight[worker] = None
+            self.pages[worker] += 1
+            before = len(self.executor.extractor.relations)
+            self.merged[worker] += self.executor.extractor.merge_relations(delta)
+            self.executor.url_frontier.record(
+                url, len(self.executor.extractor.relations) - before
+            )
+            # Pages of an abandoned iteration are merged but not counted.
+            if self.outstanding.pop(url, None) is not None:
+                finished += 1
+        for worker, process in list(self.workers.items()):
+            if not process.is_alive():
+                del self.workers[worker]
+                self.died.add(worker)
+                url = self.inflight.get(worker)
+                if url:
+                    # Not retried: the page may be what killed the worker.
+                    log.warning(f"Worker {worker} died while processing {url}")
+                    self.inflight[worker] = None
+                    self.executor.url_frontier.record(url, 0)
+                    if self.outstanding.pop(url, None) is not None:
+                        finished += 1
+        return finished
+
+    def halt(self) -> bool:
+        """
+        k relations are known: tell the workers to skip the URLs still queued
+        Returns:
+            False
+        """
+        self.stop.set()
+        return False
+
+    def printStats(self) -> None:
+        print("================== Worker processes =================")
+        for worker, pages in self.pages.items():
+            name = "coordinator" if worker == 0 else f"worker {worker}"
+            merged = f" relations merged: {self.merged[worker]}" if worker else ""
+            print(f"{name:<12} pages: {pages:<6}{merged}")
+
+    def close(self, timeout: float = 10.0) -> None:
+        """
+        Stop the worker processes
+        """
+        self.stop.set()
+        for _ in self.workers:
+            self.tasks.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.workers.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
@@ -1,13 +1,21 @@
 """Main executor file"""
 import argparse
+import sys
+from typing import Callable, List, Optional
 
-from lib.utils import kValue, rValue, tValue
+from lib import log as ise_log
+from lib.backends import SPANBERT_BACKENDS
+from lib.sink import SINK_FORMATS
+from lib.utils import kValue, positiveFloat, positiveInt, rValue, similarityValue, tValue
 from QueryExecutor import QueryExecutor
 
+log = ise_log.getLogger("main")
 
-def main():
+
+def build_parser() -> argparse.ArgumentParser:
     """
-    Handles command line arguments and calls the QueryExecutor
+    Builds the command line argument parser
+    (also used by the extraction server to parse submitted jobs)
     """
 
     # Taking in command line arguments
@@ -37,33 +45,352 @@ def main():
     parser.add_argument(
         "k", type=kValue, help="number of tuples that we request in the output; int > 0"
     )
+    parser.add_argument(
+        "-concurrency",
+        type=positiveInt,
+        default=10,
+        help="maximum number of webpages fetched in parallel; int > 0",
+    )
+    parser.add_argument(
+        "-per-host",
+        dest="per_host",
+        type=positiveInt,
+        default=2,
+        help="maximum number of parallel fetches to a single host; int > 0",
+    )
+    parser.add_argument(
+        "-max-page-kb",
+        dest="max_page_kb",
+        type=positiveInt,
+        default=2048,
+        help="maximum size (KB) of a webpage body that is downloaded; int > 0",
+    )
+    parser.add_argument(
+        "-mode",
+        choices=["concurrent", "pipeline"],
+        default="concurrent",
+        help="concurrent: fetch pages in parallel, then parse and extract each page; "
+        "pipeline: also overlap parsing, spaCy annotation and extraction",
+    )
+    parser.add_argument(
+        "-queue-depth",
+        dest="queue_depth",
+        type=positiveInt,
+        default=4,
+        help="maximum number of pages waiting between pipeline stages; int > 0",
+    )
+    parser.add_argument(
+        "-frontier",
+        type=positiveInt,
+        default=1,
+        help="number of unused tuples issued as queries together in each iteration; int > 0",
+    )
+    parser.add_argument(
+        "-urls-per-iteration",
+        dest="urls_per_iteration",
+        type=positiveInt,
+        default=10,
+        help="number of URLs taken from the URL frontier, highest priority first, in each iteration; int > 0",
+    )
+    parser.add_argument(
+        "-processes",
+        type=positiveInt,
+        default=1,
+        help="number of processes extracting from the pages of an iteration, each with its own models; int > 0",
+    )
+    parser.add_argument(
+        "-spacy-batch",
+        dest="spacy_batch",
+        type=positiveInt,
+        default=4,
+        help="number of webpages annotated together with nlp.pipe; int > 0",
+    )
+    parser.add_argument(
+        "-spacy-procs",
+        dest="spacy_procs",
+        type=positiveInt,
+        default=1,
+        help="number of processes nlp.pipe uses for a batch, started anew for every batch; int > 0",
+    )
+    parser.add_argument(
+        "-fast-sentences",
+        dest="fast_sentences",
+        action="store_true",
+        default=False,
+        help="split sentences with spaCy's senter instead of the dependency parser",
+    )
+    parser.add_argument(
+        "-spanbert-batch",
+        dest="spanbert_batch",
+        type=positiveInt,
+        default=32,
+        help="number of candidate pairs scored per SpanBERT forward pass; int > 0",
+    )
+    parser.add_argument(
+        "-spanbert-backend",
+        dest="spanbert_backend",
+        choices=SPANBERT_BACKENDS,
+        default="fp32",
+        help="SpanBERT inference backend: fp32 (stock PyTorch) or int8 (dynamically quantized, CPU)",
+    )
+    parser.add_argument(
+        "-dedup-threshold",
+        dest="dedup_threshold",
+        type=similarityValue,
+        default=0.9,
+        help="similarity (0-1) above which a page that nearly duplicates one already processed is skipped; 0 disables",
+    )
+    parser.add_argument(
+        "-cache",
+        default=None,
+        help="SQLite file caching webpage text across runs; disabled if omitted",
+    )
+    parser.add_argument(
+        "-cache-ttl",
+        dest="cache_ttl",
+        type=positiveFloat,
+        default=None,
+        help="hours after which cached entries expire; never if omitted; float > 0",
+    )
+    parser.add_argument(
+        "-cache-max-mb",
+        dest="cache_max_mb",
+        type=positiveFloat,
+        default=None,
+        help="total size (MB) the cache tables are trimmed to, least recently used first; float > 0",
+    )
+    parser.add_argument(
+        "-search-ttl",
+        dest="search_ttl",
+        type=positiveFloat,
+        default=24,
+        help="hours after which cached search results expire; float > 0",
+    )
+    parser.add_argument(
+        "-replay",
+        action="store_true",
+        default=False,
+        help="run only from the searches, pages and completions recorded in -cache, without network access",
+    )
+    parser.add_argument(
+        "-sentence-store",
+        dest="sentence_store",
+        action="store_true",
+        default=False,
+        help="keep the extraction results of every sentence in -cache, so repeated sentences are not scored again in later runs",
+    )
+    parser.add_argument(
+        "-metrics",
+        default=None,
+        help="file the per-stage timings and counters are written to at the end of the run ('-': stdout); disabled if omitted",
+    )
+    parser.add_argument(
+        "-metrics-format",
+        dest="metrics_format",
+        choices=["jsonl", "prometheus"],
+        default="jsonl",
+        help="format of -metrics: JSON lines or the Prometheus text format",
+    )
+    parser.add_argument(
+        "-log",
+        choices=ise_log.LOG_MODES,
+        default="verbose",
+        help="progress output: every line (verbose), iterations, URLs, page summaries and one line per relation (quiet), or the same as JSON lines (json)",
+    )
+    parser.add_argument(
+        "-relations-out",
+        dest="relations_out",
+        default=None,
+        help="file every relation is appended to as soon as it passes the threshold; disabled if omitted",
+    )
+    parser.add_argument(
+        "-relations-format",
+        dest="relations_format",
+        choices=SINK_FORMATS,
+        default="jsonl",
+        help="format of -relations-out: JSON lines or CSV",
+    )
+    parser.add_argument(
+        "-checkpoint",
+        default=None,
+        help="file the run's state (relations, seen URLs, used queries, URL frontier) is saved to between iterations; disabled if omitted",
+    )
+    parser.add_argument(
+        "-checkpoint-every",
+        dest="checkpoint_every",
+        type=positiveInt,
+        default=1,
+        help="number of iterations between two checkpoints; int > 0",
+    )
+    parser.add_argument(
+        "-resume",
+        action="store_true",
+        default=False,
+        help="continue the run saved in -checkpoint instead of starting from the seed query",
+    )
+    parser.add_argument(
+        "-completion-lru",
+        dest="completion_lru",
+        type=positiveInt,
+        default=1024,
+        help="number of GPT-3 completions memoized in memory; int > 0",
+    )
+    parser.add_argument(
+        "-llm-workers",
+        dest="llm_workers",
+        type=positiveInt,
+        default=4,
+        help="maximum number of GPT-3 requests in flight; int > 0",
+    )
+    parser.add_argument(
+        "-llm-rpm",
+        dest="llm_rpm",
+        type=positiveInt,
+        default=None,
+        help="GPT-3 requests-per-minute budget; unlimited if omitted; int > 0",
+    )
+    parser.add_argument(
+        "-llm-tpm",
+        dest="llm_tpm",
+        type=positiveInt,
+        default=None,
+        help="GPT-3 tokens-per-minute budget; unlimited if omitted; int > 0",
+    )
+    parser.add_argument(
+        "-openai-base",
+        dest="openai_base",
+        default=None,
+        help="alternative OpenAI-compatible API base URL, e.g. a local stub server",
+    )
+    parser.add_argument(
+        "-pack",
+        type=positiveInt,
+        default=1,
+        help="number of candidate sentences packed into one GPT-3 prompt; int > 0",
+    )
+    parser.add_argument(
+        "-server",
+        default=None,
+        help="URL of a running ExtractionServer (e.g. http://localhost:8080); "
+        "the job is submitted there instead of running locally",
+    )
+    return parser
 
-    args = parser.parse_args()
 
-    executor = QueryExecutor(args)
-    executor.printQueryParams()
-    # TODO: printQueryParams before loading the libraries. Laggy rn.
-    print("Loading necessary libraries; This should take a minute or so ...\n")
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parses and validates command line arguments (sys.argv if argv is None)
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.replay and not args.cache:
+        parser.error("-replay requires -cache")
+    if args.sentence_store and not args.cache:
+        parser.error("-sentence-store requires -cache")
+    if args.resume and not args.checkpoint:
+        parser.error("-resume requires -checkpoint")
+    return args
+
 
-    iterate_further = True
-    iterations = 0
+def job_argv(args: argparse.Namespace) -> List[str]:
+    """
+    Rebuild the main.py arguments of a job from its parsed arguments, without
+    -server (searching sys.argv for it would miss abbreviations such as -serv)
+    Parameters:
+        args: the arguments as returned by parse_arguments
+    Returns:
+        argv: every option not left at its default, then "--" and the positional
+              arguments (a query may start with "-")
+    """
+    positionals, options = [], []
+    for action in build_parser()._actions:
+        value = getattr(args, action.dest, None)
+        if not action.option_strings:
+            positionals.append(str(value))
+        elif action.dest in ("help", "server") or value == action.default:
+            continue
+        elif action.nargs == 0:
+            # A store_true flag
+            options.append(action.option_strings[0])
+        else:
+            options += [action.option_strings[0], str(value)]
+    return options + ["--"] + positionals
+
+
+def run_ise(
+    executor: QueryExecutor, progress: Optional[Callable[[int, str], None]] = None
+) -> int:
+    """
+    Runs iterative set expansion until k tuples are found or no new query
+    (nor queued URL) is left. With -checkpoint, the run's state is saved
+    between iterations and once more at the end.
+    Parameters:
+        executor: the QueryExecutor to drive
+        progress: called as progress(iteration, query) at the start of every iteration
+    Returns:
+        iterations: the number of iterations run
+    """
+    # Numbering continues from the checkpoint of a resumed run, which may
+    # already have its k tuples or have stalled.
+    iterations = executor.iterations
+    iterate_further = not iterations or (
+        executor.checkContinue() and bool(executor.queries or executor.url_frontier)
+    )
     while iterate_further:
-        # Get the top 10 results for the current query
-        results = executor.getQueryResult(executor.q, 10)
-        print(f"=========== Iteration: {iterations} - Query: {executor.q} ===========")
-        for i, item in enumerate(results):
-            print(f"URL ( {i+1} / 10): {item['link']}")
-            executor.parseResult(item)
-            if not executor.checkContinue():
-                iterate_further = False
-                break
+        if progress:
+            progress(iterations, executor.q)
+        # Get the top 10 results for each query of the iteration
+        results = executor.searchQueries(10)
+        queries = " | ".join(query for query, _confidence in executor.queries)
+        log.info(
+            f"=========== Iteration: {iterations} - Query: {queries or '(queued URLs)'} ==========="
+        )
+        if not executor.parseResults(results):
+            iterate_further = False
         iterations += 1
-        # If a new iteration is needed, get the new query
-        if not executor.getNewQuery():
-            print("No new queries to try")
-            print("Exiting ...")
+        # If a new iteration is needed, get the new query; without one,
+        # continue while URLs found earlier are still queued.
+        stalled = not executor.getNewQuery() and not executor.url_frontier
+        executor.iterations = iterations
+        # The last iteration is saved whatever -checkpoint-every is.
+        executor.saveCheckpoint(force=stalled or not iterate_further)
+        if stalled:
+            log.info("No new queries to try")
+            log.info("Exiting ...")
             break
+    return iterations
+
+
+def main():
+    """
+    Handles command line arguments and calls the QueryExecutor
+    """
+    args = parse_arguments()
+    if args.server:
+        # Thin client: the server keeps the models warm between jobs.
+        from ExtractionServer import run_remote
+
+        run_remote(args.server, job_argv(args))
+        return
+
+    ise_log.configure(args.log)
+    try:
+        executor = QueryExecutor(args)
+    except ValueError as e:
+        # e.g. a -resume checkpoint of another method or relation
+        sys.exit(f"error: {e}")
+    executor.printQueryParams()
+    print("Loading necessary libraries; This should take a minute or so ...\n")
+    # Models load in the background while the first search request is in flight.
+    executor.startLoading()
+
+    iterations = run_ise(executor)
+    # The reports are printed after every progress record.
+    ise_log.flush()
     executor.printRelations()
+    executor.printRunStats()
+    executor.close()
+    ise_log.shutdown()
     print(f"Total # of iterations = {iterations}")
 
 
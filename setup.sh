@@ -3,7 +3,6 @@ sudo apt update
 sudo apt-get update
 sudo apt install python3-pip
 pip3 install -U pip setuptools wheel
-pip3 install beautifulsoup4 
 pip3 install google-api-python-client
 pip3 install openAI
 pip3 install prettytable
@@ -23,6 +22,7 @@ bash download_finetuned.sh
 # move back to repo's root dir
 cd ..
 mv lib ./SpanBERT/lib
+mv benchmarks ./SpanBERT/benchmarks
 
 # Moving files into correct dir structure for running:
 # File directory setup. These files need to be in the
@@ -31,5 +31,6 @@ mv GPT3Extractor.py ./SpanBERT
 mv main.py ./SpanBERT
 mv QueryExecutor.py ./SpanBERT
 mv SpanBertExtractor.py ./SpanBERT
+mv ExtractionServer.py ./SpanBERT
 
 echo "all set up! :)"
\ No newline at end of file